@@ -1,49 +1,176 @@
 from flask_cors import CORS
-import asyncio
 import json
 import utils
-from geth import get_temperature, get_humidity, post_temperature, post_humidity
+import encoders
+import gateway
+from notarizer import Notarizer, ReadingBatcher, MerkleAnchor
+import merkle
+import geth
 import dao
 from dotenv import load_dotenv
 from pymongo import MongoClient
 import os
+import atexit
+import asyncio
+import time
+from lazy import LazyResource
 import auth
-from flask import Flask, jsonify, request
+from flask import Blueprint, Flask, Response, jsonify, request
 import sys
 import paramiko
+from hexbytes import HexBytes
 sys.path.insert(0, 'app/auth.py')
 
-loop = asyncio.get_event_loop()
 load_dotenv()
-app = Flask("Modbus2Chain")
-CORS(app, resources={r"/*": {"origins": "https://localhost:3000"}})
-# Connessione al database MongoDB
-client = MongoClient(os.getenv("HOST"))
-db = client[os.getenv("DATABASE")]
-print(client)
-users = db["utenti"]
+# Le route vengono registrate sull'applicazione creata da create_app()
+bp = Blueprint("modbus2chain", __name__)
+
+# Paginazione keyset di /get-transactions
+transactions_page_size = int(os.getenv('TRANSACTIONS_PAGE_SIZE', '100'))
+transactions_max_page_size = int(os.getenv('TRANSACTIONS_MAX_PAGE_SIZE', '1000'))
+notarize_timeout = float(os.getenv('NOTARIZE_TIMEOUT', '300'))
 
 # Chiave segreta per la firma del token JWT (dovrebbe essere segreta)
 jwt_secret_key = os.getenv('SECRET_APP')
 
-bbb = paramiko.SSHClient()
-bbb_ip = os.getenv("BBB_IP")
-bbb_username = os.getenv('BBB_SSH_USERNAME')
-bbb_password = os.getenv('BBB_SSH_PASSWORD')
+# Dispositivo notarizzato quando la richiesta non ne indica uno
+DEFAULT_DEVICE_ID = os.getenv('DEFAULT_DEVICE_ID', '20')
 
+# Risorse esterne: ognuna viene aperta al primo utilizzo (o dal warm-up)
+notarizer = None
+batcher = None
+anchor = None
+# Tempi di avvio del processo, esposti da /health
+startup = {}
 
-# SSH connection to the BBB
-bbb.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-bbb.connect(bbb_ip, username=bbb_username, password=bbb_password)
-utils.load_files_on_bbb(bbb)
 
+# Caricamento di umodbus e master.py sui gateway, da eseguire una volta per deploy
+def deploy_gateways(gateway_ids=None):
+    registry = gateway.load_registry()
+    try:
+        selected = [registry.get(gateway_id) for gateway_id in gateway_ids] if gateway_ids else list(registry)
+        return all([gw.deploy() for gw in selected])
+    finally:
+        registry.close()
 
-@app.route('/')
+
+# Connessione al database MongoDB
+def open_mongo():
+    client = MongoClient(os.getenv("HOST"))
+    db = client[os.getenv("DATABASE")]
+    dao.ensure_indexes(db)
+    return db
+
+
+# Scrittura bufferizzata delle transazioni notarizzate, svuotata anche all'uscita
+def open_transaction_writer():
+    return dao.TransactionWriter(mongo.get(), max_size=int(os.getenv('TRANSACTION_WRITER_SIZE', '100')),
+                                 max_delay=float(os.getenv('TRANSACTION_WRITER_DELAY', '2')))
+
+
+# Registro dei gateway (BBB) con le rispettive connessioni SSH e sessioni master
+def open_gateways():
+    registry = gateway.load_registry()
+    if os.getenv('BBB_DEPLOY_ON_START') == '1':
+        for gw in registry:
+            gw.deploy()
+    registry.connect_all()
+    return registry
+
+
+mongo = LazyResource("mongodb", open_mongo, close=lambda db: db.client.close())
+transaction_writer = LazyResource("transaction_writer", open_transaction_writer,
+                                  close=lambda writer: writer.close())
+gateways = LazyResource("gateways", open_gateways, close=lambda registry: registry.close())
+
+
+# Il nodo Geth viene interrogato sul loop del notarizer
+def geth_probe(contract):
+    return asyncio.run_coroutine_threadsafe(geth.web3.is_connected(), notarizer.loop).result(timeout=5)
+
+
+HEALTH_CHECKS = [
+    (mongo, lambda db: db.client.admin.command('ping')),
+    (gateways, lambda registry: registry.is_active()),
+    (geth.contract, geth_probe)
+]
+
+
+def create_app():
+    """
+    Application factory: build the Flask app and start the notarizer of the
+    current worker process.
+
+    MongoDB, the gateways and Geth are opened on first use; unless
+    WARM_UP_ON_START=0 they are also opened right away in background threads,
+    so a peer that is down slows neither the startup nor the other routes.
+    Files are uploaded to the gateways only when BBB_DEPLOY_ON_START=1;
+    otherwise run `python app/app.py deploy [gateway_id ...]` once per release.
+    """
+    global notarizer, batcher, anchor
+    started = time.perf_counter()
+
+    app = Flask("Modbus2Chain")
+    CORS(app, resources={r"/*": {"origins": "https://localhost:3000"}})
+    encoders.init_app(app)
+
+    # Motore di notarizzazione asincrono (loop dedicato in un thread separato)
+    notarizer = Notarizer().start()
+    # Accumulatore per la notarizzazione di più letture in un'unica transazione
+    batcher = ReadingBatcher(notarizer, max_size=int(os.getenv('BATCH_MAX_SIZE', '50')),
+                             max_delay=float(os.getenv('BATCH_MAX_DELAY', '5')))
+    # Ancoraggio periodico della radice Merkle delle letture ad alta frequenza
+    anchor = MerkleAnchor(notarizer, lambda documents: dao.insert_merkle_leaves(mongo.get(), documents),
+                          interval=float(os.getenv('MERKLE_INTERVAL', '60')))
+    # atexit è LIFO: prima i batch e l'ancoraggio delle letture in sospeso,
+    # poi le conferme delle transazioni già inviate, il notarizer, il writer
+    # e infine MongoDB
+    atexit.register(mongo.close)
+    atexit.register(transaction_writer.close)
+    atexit.register(gateways.close)
+    atexit.register(notarizer.stop)
+    atexit.register(notarizer.drain, float(os.getenv('NOTARIZE_DRAIN_TIMEOUT', '120')))
+    atexit.register(anchor.flush_all, float(os.getenv('MERKLE_FLUSH_TIMEOUT', '120')))
+    atexit.register(batcher.flush_all, float(os.getenv('BATCH_FLUSH_TIMEOUT', '120')))
+
+    if os.getenv('WARM_UP_ON_START', '1') == '1':
+        for resource in (mongo, transaction_writer, gateways, geth.contract):
+            resource.warm_up()
+
+    app.register_blueprint(bp)
+    startup["create_app_seconds"] = time.perf_counter() - started
+    print("Modbus2Chain avviato in {:.3f}s".format(startup["create_app_seconds"]))
+    return app
+
+
+# Callback del watcher: salva su MongoDB la transazione una volta confermata
+def record_transaction(data):
+    def on_confirmed(result):
+        receipt = result["receipt"]
+        transaction_writer.get().add(receipt["transactionHash"].hex(), receipt["from"],
+                                     receipt["blockNumber"], result["timestamp"], data)
+    return on_confirmed
+
+
+# Lettura tramite il demone master del gateway richiesto (il predefinito se None)
+def read_sensor(command, gateway_id=None, device_id=None):
+    return gateways.get().get(gateway_id).read_int(command, device_id)
+
+
+# Utente autenticato: l'indirizzo arriva dai claims del token e il database
+# viene consultato solo se il token non riporta ancora un indirizzo validatore
+def token_user(claims):
+    if claims.get('address'):
+        return {"email": claims.get('email'), "address": claims['address'], "validator": True}
+    return dao.find_user_summary(mongo.get(), claims.get('email'))
+
+
+@bp.route('/')
 def home():
     return "Welcome to Modbus2Chain Server"
 
 
-@app.route('/register', methods=['POST'])
+@bp.route('/register', methods=['POST'])
 def register():
     try:
         # Estrai i dati dal corpo della richiesta JSON
@@ -57,13 +184,10 @@ def register():
         if not email or not password:
             return jsonify({"error": "Email and password are required"}), 400
 
-        existing_user = dao.find_user_by_email(db, email)
-        if existing_user:
+        # Crea un nuovo utente nel database (False se l'email è già registrata)
+        if not dao.register_user(mongo.get(), email, password, first_name, last_name):
             return jsonify({"error": "User already exists"}), 409
 
-        # Crea un nuovo utente nel database (puoi implementare questa funzione in base alle tue esigenze)
-        dao.register_user(db, email, password, first_name, last_name)
-
         # 201 Created
         return jsonify({"message": "Registration successful"}), 201
 
@@ -72,7 +196,7 @@ def register():
 
 
 # Route per il login
-@app.route('/login', methods=['POST'])
+@bp.route('/login', methods=['POST'])
 def login():
     try:
         # Apply the authenticate_token_app middleware function here
@@ -84,7 +208,7 @@ def login():
         # Verifica se email e password sono forniti
         if not email or not password:
             return jsonify({"error": "Email and password are required"}), 400
-        user = dao.login_user(db, email, password)
+        user = dao.login_user(mongo.get(), email, password)
 
         if user == False:
             return jsonify({"error": "Invalid email or password"}), 401
@@ -104,181 +228,290 @@ def login():
         return jsonify({"error": str(e)}), 500
 
 
-@app.route('/view-temperature', methods=['GET'])
-def view_temperature():
+@bp.route('/view-temperature', methods=['GET'])
+@bp.route('/gateways/<gateway_id>/devices/<device_id>/view-temperature', methods=['GET'])
+def view_temperature(gateway_id=None, device_id=None):
     try:
         # Apply the authenticate_token_app middleware function here
-        auth.authenticate_token(request.headers.get('Authorization'))
-        python_command = 'python3 /var/lib/cloud9/Modbus2Chain-master/utils.py get_temp_from_slave'
-        # Esegui il comando Python
-        stdin, stdout, stderr = bbb.exec_command(python_command)
-
-        temp = int(stdout.read().decode('utf-8').splitlines()[-1])
+        claims = auth.authenticate_token(request.headers.get('Authorization'))
+        if (not claims):
+            return jsonify({"message": "Unauthorized"}), 401
+        # Lettura tramite il demone master del gateway
+        temp = read_sensor('get_temp_from_slave', gateway_id, device_id)
         print(temp)
         return jsonify({"message": "Temperatura estrapolata tramite comunicazione Modbus TCP", "temperature": temp}), 200
 
+    except gateway.UnknownTargetError as e:
+        return jsonify({"error": str(e)}), 404
+
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 
-@app.route('/view-humidity', methods=['GET'])
-def view_humidity():
+@bp.route('/view-humidity', methods=['GET'])
+@bp.route('/gateways/<gateway_id>/devices/<device_id>/view-humidity', methods=['GET'])
+def view_humidity(gateway_id=None, device_id=None):
     try:
         # Apply the authenticate_token_app middleware function here
-        auth.authenticate_token(request.headers.get('Authorization'))
-        python_command = 'python3 /var/lib/cloud9/Modbus2Chain-master/utils.py get_hum_from_slave'
-        # Esegui il comando Python
-        stdin, stdout, stderr = bbb.exec_command(python_command)
-
-        hum = int(stdout.read().decode('utf-8').splitlines()[-1])
+        claims = auth.authenticate_token(request.headers.get('Authorization'))
+        if (not claims):
+            return jsonify({"message": "Unauthorized"}), 401
+        # Lettura tramite il demone master del gateway
+        hum = read_sensor('get_hum_from_slave', gateway_id, device_id)
 
         return jsonify({"message": "Umidità estrapolata tramite comunicazione Modbus TCP", "humidity": hum}), 200
 
+    except gateway.UnknownTargetError as e:
+        return jsonify({"error": str(e)}), 404
+
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 
-@app.route('/detects-movement', methods=['GET'])
-def detects_movement():
+@bp.route('/detects-movement', methods=['GET'])
+@bp.route('/gateways/<gateway_id>/devices/<device_id>/detects-movement', methods=['GET'])
+def detects_movement(gateway_id=None, device_id=None):
     try:
         # Apply the authenticate_token_app middleware function here
-        auth.authenticate_token(request.headers.get('Authorization'))
-        python_command = 'python3 /var/lib/cloud9/Modbus2Chain-master/utils.py detects_movement'
-        # Esegui il comando Python
-        stdin, stdout, stderr = bbb.exec_command(python_command)
-
-        mov = int(stdout.read().decode('utf-8').splitlines()[-1])
+        claims = auth.authenticate_token(request.headers.get('Authorization'))
+        if (not claims):
+            return jsonify({"message": "Unauthorized"}), 401
+        # Lettura tramite il demone master del gateway
+        mov = read_sensor('detects_movement', gateway_id, device_id)
 
         return jsonify({"message": "Umidità estrapolata tramite comunicazione Modbus TCP", "humidity": mov}), 200
 
+    except gateway.UnknownTargetError as e:
+        return jsonify({"error": str(e)}), 404
+
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 
-@app.route('/notarize-temperature', methods=['POST'])
-def notarize_temperature():
+@bp.route('/view-snapshot', methods=['GET'])
+@bp.route('/gateways/<gateway_id>/devices/<device_id>/view-snapshot', methods=['GET'])
+def view_snapshot(gateway_id=None, device_id=None):
     try:
         # Apply the authenticate_token_app middleware function here
-        auth.authenticate_token(request.headers.get('Authorization'))
+        claims = auth.authenticate_token(request.headers.get('Authorization'))
+        if (not claims):
+            return jsonify({"message": "Unauthorized"}), 401
+        # Tutti i registri del dispositivo con il minor numero di letture Modbus
+        record = gateways.get().get(gateway_id).request('get_snapshot', device_id)
 
-        user = dao.find_user_by_email(db, request.form.get('email'))
+        return jsonify({"message": "Registri estrapolati tramite comunicazione Modbus TCP", "registers": record["value"], "latency_ms": record["latency_ms"]}), 200
+
+    except gateway.UnknownTargetError as e:
+        return jsonify({"error": str(e)}), 404
+
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+@bp.route('/notarize-temperature', methods=['POST'])
+@bp.route('/gateways/<gateway_id>/devices/<device_id>/notarize-temperature', methods=['POST'])
+def notarize_temperature(gateway_id=None, device_id=None):
+    try:
+        # Apply the authenticate_token_app middleware function here
+        claims = auth.authenticate_token(request.headers.get('Authorization'))
+        if (not claims):
+            return jsonify({"message": "Unauthorized"}), 401
+
+        user = token_user(claims)
         if (not user):
             return jsonify({"error": "L'email non è presente nel database, utente inesistente"}), 401
         if (not user.get('address')):
             return jsonify({"error": "L'utente non è un validatore sulla blockchain e non può caricare dati e inserire blocchi."}), 401
-        python_command = 'python3 /var/lib/cloud9/Modbus2Chain-master/utils.py get_temp_from_slave'
-
-        # Esegui il comando Python
-        stdin, stdout, stderr = bbb.exec_command(python_command)
-
-        temp = int(stdout.read().decode('utf-8').splitlines()[-1])
-        result = loop.run_until_complete(
-            post_temperature(user.get('address'), "20", temp))
+        # Lettura tramite il demone master del gateway
+        temp = read_sensor('get_temp_from_slave', gateway_id, device_id)
+        device = device_id or DEFAULT_DEVICE_ID
+        if request.form.get('mode') == 'merkle':
+            reading = anchor.add(user.get('address'), device, "temperature", temp)
+            return jsonify({"message": "Temperatura estrapolata tramite comunicazione Modbus TCP e in attesa di ancoraggio Merkle", "temperature": temp, "reading_id": reading["reading_id"]}), 202
+        if request.form.get('mode') != 'batch':
+            # La ricevuta viene attesa in background dal watcher
+            tx_hash = notarizer.submit("temperature", user.get('address'), device, temp,
+                                       on_confirmed=record_transaction("Temp: "+str(temp)+"°C")).result(timeout=notarize_timeout)
+            return jsonify({"message": "Temperatura estrapolata tramite comunicazione Modbus TCP e inviata su blockchain Ethereum", "temperature": temp, "transactionHash": tx_hash.hex(), "status": "pending"}), 202
+        result = batcher.add(user.get('address'), device, "temperature", temp).result(timeout=notarize_timeout)
         print("ssss")
-        receipt_dict = dict(result["receipt"])
-
-        # Trasforma gli oggetti HexBytes in stringhe
-        receipt_dict['blockHash'] = receipt_dict['blockHash'].hex()
-        receipt_dict['logsBloom'] = receipt_dict['logsBloom'].hex()
-        receipt_dict['transactionHash'] = receipt_dict['transactionHash'].hex()
-        if (receipt_dict['status'] == 1):
-            for log_entry in receipt_dict['logs']:
-                for log_entry in receipt_dict['logs']:
-                    if isinstance(log_entry, dict) and 'topics' in log_entry:
-                        # Cambia gli oggetti HexBytes nei campi specifici
-                        log_entry['address'] = log_entry['address'].hex()
-                        log_entry['data'] = log_entry['data'].hex()
-                        log_entry['blockHash'] = log_entry['blockHash'].hex()
-                        log_entry['transactionHash'] = log_entry['transactionHash'].hex()
-                        log_entry['blockNumber'] = log_entry['blockNumber'].hex()
-                        log_entry['transactionIndex'] = log_entry['transactionIndex'].hex(
-                        )
-                        log_entry['blockHash'] = log_entry['blockHash'].hex()
-            receipt_dict['logs'] = dict(receipt_dict['logs'])
-            receipt_dict['timestamp'] = result["timestamp"]
-        dao.insert_transaction(db, receipt_dict["transactionHash"], receipt_dict["from"],
-                               receipt_dict["blockNumber"], result["timestamp"], "Temp: "+str(temp)+"°C")
-        return jsonify({"message": "Temperatura estrapolata tramite comunicazione Modbus TCP e notarizzata su blockchain Ethereum", "temperature": temp, "blockchain_receipt": receipt_dict}), 200
+        # Ricevuta convertita in JSON in un'unica passata
+        receipt_dict = encoders.encode_receipt(result["receipt"], result["timestamp"])
+        transaction_writer.get().add(receipt_dict["transactionHash"], receipt_dict["from"],
+                                     receipt_dict["blockNumber"], result["timestamp"], "Temp: "+str(temp)+"°C",
+                                     batch_index=result["index"])
+        return jsonify({"message": "Temperatura estrapolata tramite comunicazione Modbus TCP e notarizzata su blockchain Ethereum", "temperature": temp, "blockchain_receipt": receipt_dict, "included": result.get("included", True)}), 200
+
+    except gateway.UnknownTargetError as e:
+        return jsonify({"error": str(e)}), 404
 
     except Exception as e:
         # Gestisci eccezioni
         return jsonify({"error": str(e)}), 500
 
 
-@app.route('/notarize-humidity', methods=['POST'])
-def notarize_humidity():
+@bp.route('/notarize-humidity', methods=['POST'])
+@bp.route('/gateways/<gateway_id>/devices/<device_id>/notarize-humidity', methods=['POST'])
+def notarize_humidity(gateway_id=None, device_id=None):
     try:
         # Apply the authenticate_token_app middleware function here
-        auth.authenticate_token(request.headers.get('Authorization'))
-        user = dao.find_user_by_email(db, request.form.get('email'))
+        claims = auth.authenticate_token(request.headers.get('Authorization'))
+        if (not claims):
+            return jsonify({"message": "Unauthorized"}), 401
+        user = token_user(claims)
         if (not user):
             return jsonify({"error": "L'email non è presente nel database, utente inesistente"}), 401
         if (not user.get('address')):
             return jsonify({"error": "L'utente non è un validatore sulla blockchain e non può caricare dati e inserire blocchi."}), 401
-        python_command = 'python3 /var/lib/cloud9/Modbus2Chain-master/utils.py get_hum_from_slave'
-        # Esegui il comando Python
-        stdin, stdout, stderr = bbb.exec_command(python_command)
-        hum = int(stdout.read().decode('utf-8').splitlines()[-1])
+        # Lettura tramite il demone master del gateway
+        hum = read_sensor('get_hum_from_slave', gateway_id, device_id)
+        device = device_id or DEFAULT_DEVICE_ID
         print(hum)
-        result = loop.run_until_complete(
-            post_humidity(user.get('address'), "20", hum))
-        receipt_dict = dict(result["receipt"])
-
-        # Trasforma gli oggetti HexBytes in stringhe
-        receipt_dict['blockHash'] = receipt_dict['blockHash'].hex()
-        receipt_dict['logsBloom'] = receipt_dict['logsBloom'].hex()
-        receipt_dict['transactionHash'] = receipt_dict['transactionHash'].hex()
-        if (receipt_dict['status'] == 1):
-            for log_entry in receipt_dict['logs']:
-                for log_entry in receipt_dict['logs']:
-                    if isinstance(log_entry, dict) and 'topics' in log_entry:
-                        # Cambia gli oggetti HexBytes nei campi specifici
-                        log_entry['address'] = log_entry['address'].hex()
-                        log_entry['data'] = log_entry['data'].hex()
-                        log_entry['blockHash'] = log_entry['blockHash'].hex()
-                        log_entry['transactionHash'] = log_entry['transactionHash'].hex()
-                        log_entry['blockNumber'] = log_entry['blockNumber'].hex()
-                        log_entry['transactionIndex'] = log_entry['transactionIndex'].hex(
-                        )
-                        log_entry['blockHash'] = log_entry['blockHash'].hex()
-            receipt_dict['logs'] = dict(receipt_dict['logs'])
-            receipt_dict['timestamp'] = result["timestamp"]
-        dao.insert_transaction(db, receipt_dict["transactionHash"], receipt_dict["from"],
-                               receipt_dict["blockNumber"], result["timestamp"], "Hum: "+str(hum)+"%")
-
-        return jsonify({"message": "Umidità estrapolata tramite comunicazione Modbus TCP e notarizzata su blockchain Ethereum", "humidity": hum, "blockchain_receipt": receipt_dict}), 200
+        if request.form.get('mode') == 'merkle':
+            reading = anchor.add(user.get('address'), device, "humidity", hum)
+            return jsonify({"message": "Umidità estrapolata tramite comunicazione Modbus TCP e in attesa di ancoraggio Merkle", "humidity": hum, "reading_id": reading["reading_id"]}), 202
+        if request.form.get('mode') != 'batch':
+            # La ricevuta viene attesa in background dal watcher
+            tx_hash = notarizer.submit("humidity", user.get('address'), device, hum,
+                                       on_confirmed=record_transaction("Hum: "+str(hum)+"%")).result(timeout=notarize_timeout)
+            return jsonify({"message": "Umidità estrapolata tramite comunicazione Modbus TCP e inviata su blockchain Ethereum", "humidity": hum, "transactionHash": tx_hash.hex(), "status": "pending"}), 202
+        result = batcher.add(user.get('address'), device, "humidity", hum).result(timeout=notarize_timeout)
+        # Ricevuta convertita in JSON in un'unica passata
+        receipt_dict = encoders.encode_receipt(result["receipt"], result["timestamp"])
+        transaction_writer.get().add(receipt_dict["transactionHash"], receipt_dict["from"],
+                                     receipt_dict["blockNumber"], result["timestamp"], "Hum: "+str(hum)+"%",
+                                     batch_index=result["index"])
+
+        return jsonify({"message": "Umidità estrapolata tramite comunicazione Modbus TCP e notarizzata su blockchain Ethereum", "humidity": hum, "blockchain_receipt": receipt_dict, "included": result.get("included", True)}), 200
+
+    except gateway.UnknownTargetError as e:
+        return jsonify({"error": str(e)}), 404
 
     except Exception as e:
         # Gestisci eccezioni
         return jsonify({"error": str(e)}), 500
 
 
-@app.route('/get-transactions', methods=['POST'])
+@bp.route('/merkle-proof', methods=['POST'])
+def merkle_proof():
+    try:
+        # Apply the authenticate_token_app middleware function here
+        claims = auth.authenticate_token(request.headers.get('Authorization'))
+        if (not claims):
+            return jsonify({"message": "Unauthorized"}), 401
+
+        leaf = dao.find_merkle_leaf(mongo.get(), request.form.get('reading_id'))
+        if (not leaf):
+            return jsonify({"error": "Lettura non trovata o non ancora ancorata su blockchain"}), 404
+
+        # La prova è valida solo se la radice risulta ancorata sullo smart contract
+        anchored_at = asyncio.run_coroutine_threadsafe(
+            geth.get_root_anchored_at(HexBytes(leaf["root"])), notarizer.loop).result(timeout=notarize_timeout)
+        verified = bool(anchored_at) and merkle.verify_hex_proof(leaf["leaf"], leaf["proof"], leaf["root"])
+        return jsonify({"message": "Prova di inclusione restituita correttamente!", "reading": leaf,
+                        "verified": verified, "root_anchored_at": anchored_at}), 200
+
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+@bp.route('/transaction-status', methods=['POST'])
+def transaction_status():
+    try:
+        # Apply the authenticate_token_app middleware function here
+        claims = auth.authenticate_token(request.headers.get('Authorization'))
+        if (not claims):
+            return jsonify({"message": "Unauthorized"}), 401
+
+        tx_hash = request.form.get('tx_hash')
+        if (not tx_hash):
+            return jsonify({"error": "tx_hash is required"}), 400
+        if notarizer.watcher.is_pending(HexBytes(tx_hash)):
+            return jsonify({"txID": tx_hash, "status": "pending"}), 200
+        # Non minata entro il timeout: resta osservata e viene salvata se minata più tardi
+        if notarizer.watcher.is_expired(HexBytes(tx_hash)):
+            return jsonify({"txID": tx_hash, "status": "expired"}), 200
+
+        transaction = transaction_writer.get().find(tx_hash) or dao.find_transaction(mongo.get(), tx_hash)
+        if (not transaction):
+            return jsonify({"error": "Transazione non trovata"}), 404
+        return jsonify({"txID": tx_hash, "status": "confirmed", "transaction": transaction}), 200
+
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+@bp.route('/metrics', methods=['GET'])
+def metrics():
+    try:
+        # Apply the authenticate_token_app middleware function here
+        claims = auth.authenticate_token(request.headers.get('Authorization'))
+        if (not claims):
+            return jsonify({"message": "Unauthorized"}), 401
+
+        return jsonify({"block_header_cache": geth.block_headers.stats(),
+                        "pending_transactions": notarizer.watcher.pending_count(),
+                        "transaction_writer": transaction_writer.get().stats(),
+                        "gateways": gateways.get().stats(),
+                        "user_cache": dao.user_cache.stats()}), 200
+
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+# Stato delle dipendenze esterne, senza autenticazione per i load balancer
+@bp.route('/health', methods=['GET'])
+def health():
+    dependencies = {resource.name: resource.health(probe) for resource, probe in HEALTH_CHECKS}
+    # Una risorsa "idle" non è ancora stata aperta: non rende il worker non disponibile
+    healthy = all(dependency["status"] != "down" for dependency in dependencies.values())
+    return jsonify({"status": "up" if healthy else "degraded", "dependencies": dependencies,
+                    "startup": startup}), 200 if healthy else 503
+
+
+@bp.route('/get-transactions', methods=['POST'])
 def get_transactions():
     try:
         # Apply the authenticate_token_app middleware function here
-        auth.authenticate_token(request.headers.get('Authorization'))
+        claims = auth.authenticate_token(request.headers.get('Authorization'))
+        if (not claims):
+            return jsonify({"message": "Unauthorized"}), 401
 
-        user = dao.find_user_by_email(db, request.form.get('email'))
+        user = token_user(claims)
         print(user)
-        if (not user.get('address')):
+        if (not user or not user.get('address')):
             return jsonify({"message": "L'utente non è un validatore sulla blockchain e non può caricare dati e inserire blocchi."}), 401
 
-        transactions = dao.get_transactions_by_from_address(
-            db, user.get('address'))
-        return jsonify({"message": "Transazioni restituite correttamente!", "transactions": transactions}), 200
+        cursor = request.form.get('cursor')
+        limit = max(1, min(int(request.form.get('limit', transactions_page_size)), transactions_max_page_size))
+
+        if request.form.get('format') == 'ndjson':
+            # Streaming: il cursore di pymongo viene consumato un documento alla volta
+            transactions = dao.iter_transactions_by_from_address(mongo.get(), user.get('address'), cursor)
+
+            def generate():
+                for transaction in transactions:
+                    del transaction["_id"]
+                    yield json.dumps(transaction) + '\n'
+            return Response(generate(), mimetype='application/x-ndjson'), 200
+
+        transactions, next_cursor = dao.get_transactions_page(
+            mongo.get(), user.get('address'), cursor, limit)
+        return jsonify({"message": "Transazioni restituite correttamente!", "transactions": transactions, "next_cursor": next_cursor}), 200
 
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 
-@app.route('/is-validator', methods=['POST'])
+@bp.route('/is-validator', methods=['POST'])
 def is_validator():
     try:
         # Apply the authenticate_token_app middleware function here
-        auth.authenticate_token(request.headers.get('Authorization'))
+        claims = auth.authenticate_token(request.headers.get('Authorization'))
+        if (not claims):
+            return jsonify({"message": "Unauthorized"}), 401
 
-        result = dao.is_validator(db, request.form.get('email'))
+        result = dao.is_validator(mongo.get(), request.form.get('email'))
         if (not result):
             return jsonify({"error": "L'utente non è un validatore sulla blockchain e non può caricare dati e inserire blocchi."}), 401
 
@@ -288,5 +521,10 @@ def is_validator():
         return jsonify({"error": str(e)}), 500
 
 
-app.run(host='0.0.0.0', port=5000, debug=True, ssl_context=(
-    'web-server/server.crt', 'web-server/server.key'), threaded=True)
+# Server di sviluppo; in produzione usare wsgi.py con gunicorn o uvicorn
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['deploy']:
+        sys.exit(0 if deploy_gateways(sys.argv[2:]) else 1)
+    create_app().run(host='0.0.0.0', port=5000, debug=os.getenv('FLASK_DEBUG') == '1',
+                     use_reloader=False, ssl_context=('web-server/server.crt', 'web-server/server.key'),
+                     threaded=True)
@@ -1,10 +1,14 @@
-from flask import jsonify
 import jwt
 import datetime
+import hashlib
 import os
-from bson import ObjectId
 import secrets
-import json
+import time
+from cache import TTLCache
+
+# Claims dei token già verificati, indicizzati per digest del token
+claims_cache = TTLCache(maxsize=int(os.getenv('TOKEN_CACHE_SIZE', '4096')),
+                        ttl=30 * 60)
 
 
 # Funzione middleware per l'autenticazione dell'app
@@ -19,34 +23,35 @@ def authenticate_token_app(auth_header):
             return True
     return False
 
-# Funzione middleware per l'autenticazione
-
-
+# Funzione middleware per l'autenticazione.
+# Restituisce i claims del token (email, indirizzo validatore) oppure False.
+# I claims già validati restano in cache fino alla scadenza del token.
 def authenticate_token(auth_header):
-    token = auth_header and auth_header.split(' ')[1]
+    token = auth_header and auth_header.split(' ')[-1]
     if not token:
         return False
+    token_digest = hashlib.sha256(token.encode()).hexdigest()
+    claims = claims_cache.get(token_digest)
+    if claims is not None:
+        return claims
     try:
-        jwt.decode(token, os.environ['JWT_SECRET'], algorithms=["HS256"])
-        return True
-    except jwt.ExpiredSignatureError:
-        return jsonify({"message": "Unauthorized"}), 401
+        claims = jwt.decode(token, os.environ['JWT_SECRET'], algorithms=["HS256"])
     except jwt.InvalidTokenError:
-        return jsonify({"message": "Unauthorized"}), 401
-
-
-def serialize_object_id(obj):
-    if isinstance(obj, ObjectId):
-        return str(obj)  # Converti l'ObjectId in una stringa
-    raise TypeError(f"Object of type {type(obj)} is not JSON serializable")
+        # Comprende anche jwt.ExpiredSignatureError
+        return False
+    claims_cache.put(token_digest, claims,
+                     ttl=claims.get("exp", time.time() + claims_cache.ttl) - time.time())
+    return claims
 
 
+# Token compatto: solo id, email e indirizzo validatore dell'utente
 def generate_jwt_token(user):
     expiration_time = datetime.datetime.utcnow() + datetime.timedelta(minutes=30)
     payload = {
         "exp": expiration_time,
-        # Serializza ObjectId
-        "user": json.loads(json.dumps(user, default=serialize_object_id)),
+        "sub": str(user["_id"]),
+        "email": user["email"],
+        "address": user.get("address")
     }
     token = jwt.encode(payload, os.getenv('JWT_SECRET'), algorithm="HS256")
     return token
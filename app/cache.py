@@ -0,0 +1,93 @@
+import collections
+import threading
+import time
+
+
+class LRUCache:
+    """
+    Bounded thread-safe LRU cache with hit/miss counters.
+
+    get() returns default on a miss; the least recently used entry is evicted
+    once maxsize entries are stored.
+    """
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0
+        }
+
+
+class TTLCache(LRUCache):
+    """
+    LRU cache whose entries also expire ttl seconds after being stored.
+
+    put() accepts a per-entry ttl; expired entries count as misses.
+    """
+
+    def __init__(self, maxsize=1024, ttl=60.0):
+        super().__init__(maxsize)
+        self.ttl = ttl
+        self.expired = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                expires, value = entry
+                if expires > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+                self.expired += 1
+            self.misses += 1
+            return default
+
+    def put(self, key, value, ttl=None):
+        expires = time.monotonic() + (self.ttl if ttl is None else ttl)
+        super().put(key, (expires, value))
+
+    def stats(self):
+        stats = super().stats()
+        stats["ttl"] = self.ttl
+        stats["expired"] = self.expired
+        return stats
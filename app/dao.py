@@ -1,10 +1,70 @@
 from werkzeug.security import generate_password_hash, check_password_hash
+from pymongo import ASCENDING
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from bson import ObjectId
+from cache import TTLCache
+from concurrent.futures import ProcessPoolExecutor
+import collections
+import itertools
+import multiprocessing
+import threading
+import os
+
+# Campi restituiti per ogni transazione notarizzata
+TRANSACTION_PROJECTION = {"_id": 0, "txID": 1, "validator_address": 1,
+                          "block_number": 1, "timestamp": 1, "data": 1}
+
+# Cache email -> indirizzo e flag validatore, per gli endpoint interrogati spesso.
+# Ogni processo ha la sua cache: il TTL limita quanto può restare indietro.
+# L'indirizzo viene assegnato fuori dall'applicazione (direttamente nella
+# collezione utenti), quindi un nuovo validatore è visto entro USER_CACHE_TTL.
+user_cache = TTLCache(maxsize=int(os.getenv('USER_CACHE_SIZE', '4096')),
+                      ttl=float(os.getenv('USER_CACHE_TTL', '60')))
+_MISSING = object()
+
+# Parametri di hashing delle password, es. "pbkdf2:sha256:600000"
+PASSWORD_HASH_METHOD = os.getenv('PASSWORD_HASH_METHOD', 'pbkdf2:sha256')
+PASSWORD_SALT_LENGTH = int(os.getenv('PASSWORD_SALT_LENGTH', '16'))
+# Hash e verifica girano in un pool di processi limitato, fuori dai thread di Flask
+PASSWORD_POOL_SIZE = int(os.getenv('PASSWORD_POOL_SIZE', str(os.cpu_count() or 1)))
+_password_pool = None
+_password_pool_lock = threading.Lock()
+
+
+def ensure_indexes(db):
+    """Create the indexes the queries of this module rely on (idempotent)"""
+    db["utenti"].create_index([("email", ASCENDING)], unique=True)
+    db["transactions"].create_index(
+        [("validator_address", ASCENDING), ("timestamp", ASCENDING), ("_id", ASCENDING)])
+    # Le letture di un batch condividono la stessa transazione
+    db["transactions"].create_index(
+        [("txID", ASCENDING), ("batch_index", ASCENDING)], unique=True)
+    db["merkle_leaves"].create_index([("reading_id", ASCENDING)], unique=True)
+
+
+def get_password_pool():
+    global _password_pool
+    with _password_pool_lock:
+        if _password_pool is None:
+            # Il pool nasce quando i thread di Flask e del notarizer sono già
+            # attivi: con fork un worker potrebbe ereditare un lock acquisito
+            _password_pool = ProcessPoolExecutor(
+                max_workers=PASSWORD_POOL_SIZE, mp_context=multiprocessing.get_context('spawn'))
+        return _password_pool
+
+
+def hash_password(password):
+    return get_password_pool().submit(
+        generate_password_hash, password, PASSWORD_HASH_METHOD, PASSWORD_SALT_LENGTH).result()
+
+
+def verify_password(password_hash, password):
+    return get_password_pool().submit(check_password_hash, password_hash, password).result()
 
 
 def register_user(db, email, password, first_name, last_name):
     users = db['utenti']
-    hashed_password = generate_password_hash(password)
-    print(hashed_password)
+    hashed_password = hash_password(password)
     user_data = {
         'email': email,
         'password': hashed_password,
@@ -12,34 +72,25 @@ def register_user(db, email, password, first_name, last_name):
         'last_name': last_name
     }
 
-    if users.find_one({"email": email}):
+    # L'indice unico sull'email sostituisce il controllo preventivo
+    try:
+        users.insert_one(user_data)
+    except DuplicateKeyError:
         return False
-
-    users.insert_one(user_data)
-    print("eccoci")
+    user_cache.invalidate(email)
     return True
 
 
 def login_user(db, email, password):
     users = db['utenti']
-    user = users.find_one({"email": email})
-    if not user or not check_password_hash(user['password'], password):
+    user = users.find_one({"email": email}, {"email": 1, "password": 1, "address": 1})
+    if not user or not verify_password(user['password'], password):
         return False
 
     return user
 
 
-def find_user_by_email(db, email):
-    users_collection = db["utenti"]
-
-    user = users_collection.find_one({"email": email})
-
-    return user
-
-
-def insert_transaction(db, txID, validator_address, block_number, timestamp, data):
-    transactions_collection = db["transactions"]
-
+def transaction_record(txID, validator_address, block_number, timestamp, data, batch_index=None):
     transaction_data = {
         "txID": txID,
         "validator_address": validator_address,
@@ -47,25 +98,196 @@ def insert_transaction(db, txID, validator_address, block_number, timestamp, dat
         "timestamp": timestamp,
         "data": data
     }
+    if batch_index is not None:
+        transaction_data["batch_index"] = batch_index
+    return transaction_data
+
+
+def find_user_summary(db, email):
+    """
+    Return {"address", "validator"} for the user, or None if it does not
+    exist. Results, including missing users, are cached in user_cache.
+    """
+    summary = user_cache.get(email, _MISSING)
+    if summary is _MISSING:
+        user = db["utenti"].find_one({"email": email}, {"_id": 0, "address": 1})
+        summary = None if user is None else {"address": user.get("address"),
+                                             "validator": "address" in user}
+        user_cache.put(email, summary)
+    return summary
+
+
+class TransactionWriter:
+    """
+    Buffered writer for notarized transaction records.
 
-    transactions_collection.insert_one(transaction_data)
+    Records are written with one insert_many(ordered=False) every max_size
+    records or max_delay seconds, and stay visible to find() until written.
+    A failed write is retried max_delay seconds later; records rejected by
+    MongoDB go to on_error(record, error) and to failed_records. close()
+    flushes what is left and is meant as a shutdown hook.
+    """
 
+    def __init__(self, db, max_size=100, max_delay=2.0, on_error=None, max_failed=1000):
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self.written = 0
+        self.failed = 0
+        self.failed_records = collections.deque(maxlen=max_failed)
+        self._collection = db["transactions"]
+        self._on_error = on_error or self._print_error
+        self._buffer = []
+        self._in_flight = []
+        self._timer = None
+        self._closed = False
+        self._lock = threading.Lock()
 
-def get_transactions_by_from_address(db, from_address):
+    def add(self, txID, validator_address, block_number, timestamp, data, batch_index=None):
+        record = transaction_record(
+            txID, validator_address, block_number, timestamp, data, batch_index)
+        records = None
+        with self._lock:
+            self._buffer.append(record)
+            if len(self._buffer) >= self.max_size:
+                records = self._take()
+            else:
+                self._schedule()
+        if records:
+            self._write(records)
+
+    def find(self, txID):
+        """Return a record not yet written to MongoDB (buffered or being written)"""
+        with self._lock:
+            for record in itertools.chain(self._buffer, *self._in_flight):
+                if record["txID"] == txID:
+                    return {key: value for key, value in record.items() if key != "_id"}
+        return None
+
+    def flush(self):
+        with self._lock:
+            records = self._take()
+        if records:
+            self._write(records)
+
+    def close(self):
+        self._closed = True
+        self.flush()
+
+    def _schedule(self):
+        if self._timer is None and not self._closed:
+            self._timer = threading.Timer(self.max_delay, self.flush)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _take(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        records, self._buffer = self._buffer, []
+        if records:
+            self._in_flight.append(records)
+        return records
+
+    def _write(self, records):
+        retry_error = None
+        try:
+            result = self._collection.insert_many(records, ordered=False)
+            self.written += len(result.inserted_ids)
+        except BulkWriteError as e:
+            self.written += e.details.get('nInserted', 0)
+            for error in e.details.get('writeErrors', []):
+                self._fail(records[error['index']], error)
+        except Exception as e:
+            # Errore dell'intera scrittura (es. database non raggiungibile)
+            retry_error = e
+        with self._lock:
+            self._in_flight = [batch for batch in self._in_flight if batch is not records]
+            if retry_error is not None and not self._closed:
+                # I record tornano in testa al buffer e restano visibili a find()
+                self._buffer[:0] = records
+                self._schedule()
+                print("Scrittura di {} transazioni fallita, nuovo tentativo tra {} s: {}".format(
+                    len(records), self.max_delay, retry_error))
+                return
+        if retry_error is not None:
+            for record in records:
+                self._fail(record, {"errmsg": str(retry_error)})
+
+    def _fail(self, record, error):
+        self.failed += 1
+        self.failed_records.append({"record": record, "error": error.get('errmsg')})
+        self._on_error(record, error)
+
+    @staticmethod
+    def _print_error(record, error):
+        print("Salvataggio della transazione {} fallito: {}".format(
+            record["txID"], error.get('errmsg')))
+
+    def stats(self):
+        return {"buffered": len(self._buffer), "in_flight": sum(len(batch) for batch in self._in_flight),
+                "written": self.written, "failed": self.failed}
+
+
+def find_transaction(db, txID):
     transactions_collection = db["transactions"]
-    transactions = transactions_collection.find(
-        {"validator_address": from_address})
+    return transactions_collection.find_one({"txID": txID}, TRANSACTION_PROJECTION)
+
+
+def encode_cursor(transaction):
+    return "{}_{}".format(transaction["timestamp"], transaction["_id"])
+
+
+def decode_cursor(cursor):
+    timestamp, _, object_id = cursor.partition('_')
+    if not ObjectId.is_valid(object_id):
+        raise ValueError("Invalid cursor: {}".format(cursor))
+    return int(timestamp), ObjectId(object_id)
+
+
+def iter_transactions_by_from_address(db, from_address, cursor=None, limit=0):
+    """
+    Iterate lazily over the transactions of a validator in (timestamp, _id)
+    order, starting after the given keyset cursor. The documents keep their
+    _id so that the caller can build the next cursor.
+    """
+    transactions_collection = db["transactions"]
+    query = {"validator_address": from_address}
+    if cursor:
+        timestamp, object_id = decode_cursor(cursor)
+        query["$or"] = [{"timestamp": {"$gt": timestamp}},
+                        {"timestamp": timestamp, "_id": {"$gt": object_id}}]
+
+    projection = dict(TRANSACTION_PROJECTION, _id=1)
+    return transactions_collection.find(query, projection).sort(
+        [("timestamp", ASCENDING), ("_id", ASCENDING)]).limit(limit)
+
+
+def get_transactions_page(db, from_address, cursor=None, limit=100):
+    transactions = list(iter_transactions_by_from_address(db, from_address, cursor, limit))
+    next_cursor = encode_cursor(transactions[-1]) if len(transactions) == limit else None
+    for transaction in transactions:
+        del transaction["_id"]
+    return transactions, next_cursor
+
+
+# Idempotente: le foglie già salvate da un tentativo precedente vengono ignorate
+def insert_merkle_leaves(db, leaves):
+    merkle_leaves_collection = db["merkle_leaves"]
+    try:
+        merkle_leaves_collection.insert_many(leaves, ordered=False)
+    except BulkWriteError as e:
+        if any(error['code'] != 11000 for error in e.details.get('writeErrors', [])):
+            raise
 
-    transactions_list = [{"txID": transaction["txID"], "validator_address": transaction["validator_address"],
-                          "block_number": transaction["block_number"], "timestamp": transaction["timestamp"], "data": transaction["data"]} for transaction in transactions]
 
-    return transactions_list
+def find_merkle_leaf(db, reading_id):
+    merkle_leaves_collection = db["merkle_leaves"]
+    return merkle_leaves_collection.find_one({"reading_id": reading_id}, {"_id": 0})
 
 
 def is_validator(db, email):
-    users_collection = db["utenti"]
-    user = users_collection.find_one({"email": email})
-    if user and "address" in user:
+    user = find_user_summary(db, email)
+    if user and user["validator"]:
         return True
     else:
         return False
@@ -0,0 +1,62 @@
+from collections.abc import Mapping
+
+try:
+    from flask.json.provider import DefaultJSONProvider
+except ImportError:  # Flask < 2.2
+    DefaultJSONProvider = None
+
+
+def encode_value(value):
+    """
+    Convert a web3 value (AttributeDict, HexBytes, lists of them) to a
+    JSON-ready structure in a single linear pass.
+    """
+    if isinstance(value, (bytes, bytearray)):
+        return '0x' + bytes(value).hex()
+    if isinstance(value, Mapping):
+        return {key: encode_value(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [encode_value(item) for item in value]
+    return value
+
+
+def encode_receipt(receipt, timestamp=None):
+    encoded = encode_value(receipt)
+    if timestamp is not None:
+        encoded['timestamp'] = timestamp
+    return encoded
+
+
+# Serializzazione diretta di HexBytes e AttributeDict nelle risposte Flask
+def _json_default(value):
+    if isinstance(value, (bytes, bytearray)):
+        return '0x' + bytes(value).hex()
+    if isinstance(value, Mapping):
+        return dict(value)
+    raise TypeError(f"Object of type {type(value)} is not JSON serializable")
+
+
+if DefaultJSONProvider is not None:
+    class Web3JSONProvider(DefaultJSONProvider):
+        @staticmethod
+        def default(value):
+            try:
+                return _json_default(value)
+            except TypeError:
+                return DefaultJSONProvider.default(value)
+else:
+    from flask.json import JSONEncoder
+
+    class Web3JSONEncoder(JSONEncoder):
+        def default(self, value):
+            try:
+                return _json_default(value)
+            except TypeError:
+                return super().default(value)
+
+
+def init_app(app):
+    if DefaultJSONProvider is not None:
+        app.json = Web3JSONProvider(app)
+    else:
+        app.json_encoder = Web3JSONEncoder
@@ -0,0 +1,271 @@
+import json
+import os
+import socket
+import threading
+import paramiko
+import utils
+
+# Il master gira come demone sul BeagleBone Black e risponde su un unico canale SSH
+MASTER_DIR = '/var/lib/cloud9/Modbus2Chain-master'
+MASTER_DAEMON_COMMAND = 'cd {} && exec python3 -u master.py serve 2>>master.log'.format(
+    MASTER_DIR)
+# Attesa massima di una risposta del demone (le connessioni Modbus usano 30 s)
+REQUEST_TIMEOUT = float(os.getenv('GATEWAY_REQUEST_TIMEOUT', '45'))
+
+
+class GatewayError(Exception):
+    """Error reported by the master daemon on the gateway"""
+
+
+class UnknownTargetError(GatewayError):
+    """Gateway or device not in the registry"""
+
+
+class GatewaySession:
+    """
+    Persistent line protocol session with the master daemon on the BBB.
+
+    Each request is a single line "<command> [ip[:port]]" and each reply a
+    single compact JSON record {"ok", "command", "value", "register",
+    "latency_ms", "error"}, so a reading costs one round trip on an already
+    open channel instead of a new interpreter per call.
+    """
+
+    def __init__(self, ssh_client, command=MASTER_DAEMON_COMMAND, timeout=REQUEST_TIMEOUT):
+        self._ssh = ssh_client
+        self._command = command
+        self._timeout = timeout
+        self._lock = threading.Lock()
+        self._stdin = None
+        self._stdout = None
+
+    @property
+    def ssh_client(self):
+        return self._ssh
+
+    def _start(self):
+        stdin, stdout, stderr = self._ssh.exec_command(self._command)
+        stdout.channel.settimeout(self._timeout)
+        self._stdin = stdin
+        self._stdout = stdout
+
+    def _stop(self):
+        if self._stdin is not None:
+            self._stdin.channel.close()
+        self._stdin = None
+        self._stdout = None
+
+    def request(self, command, target=None):
+        line = command if target is None else "{} {}".format(command, target)
+        with self._lock:
+            # Un secondo tentativo riavvia il demone se il canale è caduto
+            for attempt in range(2):
+                try:
+                    if self._stdin is None or self._stdin.channel.closed:
+                        self._start()
+                    self._stdin.write(line + '\n')
+                    self._stdin.flush()
+                    reply = self._stdout.readline()
+                except socket.timeout:
+                    # Demone bloccato: viene chiuso, la prossima richiesta ne avvia un altro
+                    self._stop()
+                    raise GatewayError("Master daemon did not answer within {} seconds".format(self._timeout))
+                except (OSError, EOFError, paramiko.SSHException):
+                    reply = ''
+                if reply:
+                    break
+                self._stop()
+            else:
+                raise GatewayError("Master daemon on the gateway is not responding")
+
+        try:
+            record = json.loads(reply)
+        except ValueError:
+            raise GatewayError("Invalid reply from the master daemon: {}".format(reply.strip()))
+        if not record.get("ok"):
+            raise GatewayError(record.get("error"))
+        return record
+
+    def read_int(self, command, target=None):
+        return int(self.request(command, target)["value"])
+
+    def close(self):
+        with self._lock:
+            if self._stdin is not None and not self._stdin.channel.closed:
+                try:
+                    self._stdin.write('quit\n')
+                    self._stdin.flush()
+                except (OSError, paramiko.SSHException):
+                    pass
+            self._stop()
+
+
+class Gateway:
+    """
+    One BBB of the fleet: an SSH connection with keepalive and up to
+    max_sessions master daemon sessions multiplexed on it.
+
+    slaves maps a device id to the "ip[:port]" of its Modbus slave (device
+    None reads the master's default slave). A slave serves one client at a
+    time, so each slave is always read through the same session; only
+    readings of different slaves run in parallel. A dead SSH transport is
+    reopened and the request retried once.
+    """
+
+    def __init__(self, gateway_id, host, username=None, password=None, port=22,
+                 slaves=None, max_sessions=1, keepalive=30, request_timeout=REQUEST_TIMEOUT):
+        self.gateway_id = gateway_id
+        self.host = host
+        self.slaves = slaves or {}
+        self.max_sessions = max_sessions
+        self._connect_args = {"port": port, "username": username, "password": password}
+        self._keepalive = keepalive
+        self._request_timeout = request_timeout
+        self._ssh = None
+        self._ssh_lock = threading.Lock()
+        self._sessions = [None] * max_sessions
+        self._sessions_lock = threading.Lock()
+        targets = [None] + list(dict.fromkeys(self.slaves.values()))
+        self._routes = {target: index % max_sessions for index, target in enumerate(targets)}
+        self.requests = 0
+        self.reconnects = 0
+
+    def connect(self):
+        ssh_client = paramiko.SSHClient()
+        ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        ssh_client.connect(self.host, **self._connect_args)
+        ssh_client.get_transport().set_keepalive(self._keepalive)
+        return ssh_client
+
+    def ssh_client(self):
+        """Current SSH connection, reopened if the transport is down"""
+        with self._ssh_lock:
+            if self._ssh is None or not self._transport_active(self._ssh):
+                if self._ssh is not None:
+                    self._ssh.close()
+                    self.reconnects += 1
+                self._ssh = None
+                self._ssh = self.connect()
+            return self._ssh
+
+    @staticmethod
+    def _transport_active(ssh_client):
+        transport = ssh_client.get_transport()
+        return transport is not None and transport.is_active()
+
+    def is_active(self):
+        ssh_client = self._ssh
+        return ssh_client is not None and self._transport_active(ssh_client)
+
+    def target(self, device_id):
+        if device_id is None:
+            return None
+        if device_id not in self.slaves:
+            raise UnknownTargetError("Unknown device {} on gateway {}".format(device_id, self.gateway_id))
+        return self.slaves[device_id]
+
+    def _session(self, index):
+        ssh_client = self.ssh_client()
+        with self._sessions_lock:
+            session = self._sessions[index]
+            if session is None or session.ssh_client is not ssh_client:
+                if session is not None:
+                    session.close()
+                session = self._sessions[index] = GatewaySession(ssh_client, timeout=self._request_timeout)
+            return session
+
+    def request(self, command, device_id=None):
+        target = self.target(device_id)
+        index = self._routes[target]
+        self.requests += 1
+        for attempt in range(2):
+            session = self._session(index)
+            try:
+                return session.request(command, target)
+            except GatewayError:
+                if attempt or self.is_active():
+                    raise
+
+    def read_int(self, command, device_id=None):
+        return int(self.request(command, device_id)["value"])
+
+    def deploy(self):
+        return utils.load_files_on_bbb(self.ssh_client())
+
+    def stats(self):
+        return {"host": self.host, "connected": self.is_active(), "max_sessions": self.max_sessions,
+                "open_sessions": sum(session is not None for session in self._sessions),
+                "requests": self.requests,
+                "reconnects": self.reconnects}
+
+    def close(self):
+        with self._sessions_lock:
+            for session in self._sessions:
+                if session is not None:
+                    session.close()
+            self._sessions = [None] * self.max_sessions
+        with self._ssh_lock:
+            if self._ssh is not None:
+                self._ssh.close()
+            self._ssh = None
+
+
+class GatewayRegistry:
+    """Gateways of the plant by id; the first one is the default gateway"""
+
+    def __init__(self, gateways):
+        if not gateways:
+            raise ValueError("At least one gateway must be configured")
+        self._gateways = {gw.gateway_id: gw for gw in gateways}
+        self.default_id = gateways[0].gateway_id
+
+    def get(self, gateway_id=None):
+        gateway_id = self.default_id if gateway_id is None else gateway_id
+        if gateway_id not in self._gateways:
+            raise UnknownTargetError("Unknown gateway {}".format(gateway_id))
+        return self._gateways[gateway_id]
+
+    def __iter__(self):
+        return iter(self._gateways.values())
+
+    def connect_all(self):
+        for gw in self:
+            try:
+                gw.ssh_client()
+            except Exception as e:
+                print("Connessione al gateway {} fallita: {}".format(gw.gateway_id, e))
+
+    def is_active(self):
+        return all(gw.is_active() for gw in self)
+
+    def stats(self):
+        return {gw.gateway_id: gw.stats() for gw in self}
+
+    def close(self):
+        for gw in self:
+            gw.close()
+
+
+def load_registry(path=None):
+    """
+    Build the registry from the JSON file GATEWAYS_FILE, a list of
+    {"id", "host", "username", "password", "port", "slaves", "max_sessions",
+    "request_timeout"};
+    without it the single BBB of BBB_IP is used. max_sessions > 1 starts that
+    many master daemons on the gateway and only helps with several slaves,
+    since each slave is always read through the same daemon (see Gateway).
+    """
+    path = path or os.getenv('GATEWAYS_FILE')
+    if not path:
+        return GatewayRegistry([Gateway(os.getenv('BBB_ID', 'bbb'), os.getenv("BBB_IP"),
+                                        username=os.getenv('BBB_SSH_USERNAME'),
+                                        password=os.getenv('BBB_SSH_PASSWORD'))])
+    with open(path) as f:
+        config = json.load(f)
+    return GatewayRegistry([Gateway(entry["id"], entry["host"], username=entry.get("username"),
+                                    password=entry.get("password"), port=entry.get("port", 22),
+                                    slaves=entry.get("slaves"),
+                                    max_sessions=entry.get("max_sessions", 1),
+                                    keepalive=entry.get("keepalive", 30),
+                                    request_timeout=entry.get("request_timeout", REQUEST_TIMEOUT))
+                            for entry in config])
@@ -1,92 +1,181 @@
-from web3 import Web3, HTTPProvider
-from web3.middleware import geth_poa_middleware
+from web3 import AsyncWeb3, AsyncHTTPProvider
+from web3.middleware import async_geth_poa_middleware
+from web3.logs import DISCARD
+from cache import LRUCache
+from lazy import LazyResource
 import asyncio
 import json
 import os
 
-# Collegati alla tua rete Geth privata (assicurati di fornire l'URL corretto)
-web3 = Web3(HTTPProvider('http://127.0.0.1:8546'))
-web3.middleware_onion.inject(geth_poa_middleware, layer=0)
-print(web3.client_version)
+# Collegati alla tua rete Geth privata (assicurati di fornire l'URL corretto).
+# Il provider è asincrono: tutte le chiamate girano sul loop del notarizer.
+web3 = AsyncWeb3(AsyncHTTPProvider('http://127.0.0.1:8546'))
+web3.middleware_onion.inject(async_geth_poa_middleware, layer=0)
 # Imposta l'indirizzo dello smart contract e l'ABI
 contract_address = os.getenv('SC_ADDRESS')
-with open('./build/contracts/IoTDataNotarization.json') as f:
-    contract_json = json.load(f)
-    abi = contract_json['abi']
+CONTRACT_ABI_PATH = './build/contracts/IoTDataNotarization.json'
 
-contract = web3.eth.contract(address=contract_address, abi=abi)
-print(contract)
+
+# L'ABI viene letto al primo utilizzo del contratto, non all'import del modulo
+def load_contract():
+    with open(CONTRACT_ABI_PATH) as f:
+        abi = json.load(f)['abi']
+    return web3.eth.contract(address=contract_address, abi=abi)
+
+
+contract = LazyResource("geth", load_contract)
 gas_limit = 200000
 gas_price = web3.to_wei('20000000000', 'wei')
 
+# Codici dei tipi di dato accettati da recordBatch nello smart contract
+READING_KINDS = {
+    "temperature": 0,
+    "humidity": 1
+}
+
 
 async def get_temperature(device_id):
-    function_data = contract.functions.readTemperatureRecord(device_id).call()
+    function_data = await contract.get().functions.readTemperatureRecord(device_id).call()
     print('Transazione GET Temperature completata. Risposta:', function_data)
     return function_data
 
 
 async def get_humidity(device_id):
-    function_data = contract.functions.readHumidityRecord(device_id).call()
+    function_data = await contract.get().functions.readHumidityRecord(device_id).call()
     print('Transazione GET Umidità completata. Risposta:', function_data)
     return function_data
 
 
-async def post_temperature(from_address, device_id, temperature):
-    print("funzione on")
-    nonce = web3.eth.get_transaction_count(from_address)
-    print(nonce)
-
-    transaction_data = contract.functions.recordTemperature(device_id, temperature).build_transaction({
-        'from': from_address,
-        'chainId': 10002,
-        'nonce': nonce
-    })
-    private_key = ""
+# Timestamp di ancoraggio di una radice Merkle, 0 se non è mai stata ancorata
+async def get_root_anchored_at(root):
+    return await contract.get().functions.anchoredRoots(root).call()
+
+
+# Cache condivisa degli header dei blocchi: numero -> timestamp e hash
+block_headers = LRUCache(maxsize=int(os.getenv('BLOCK_HEADER_CACHE_SIZE', '4096')))
+
+
+def cache_block_header(block):
+    header = {"timestamp": block['timestamp'], "hash": block['hash']}
+    block_headers.put(block['number'], header)
+    return header
+
+
+async def get_block_header(block_number):
+    header = block_headers.get(block_number)
+    if header is None:
+        header = cache_block_header(await web3.eth.get_block(block_number))
+    return header
+
+
+def get_private_key(from_address):
     if (from_address == os.getenv('1_PUB_KEY')):
-        private_key = os.getenv('1_PRIV_KEY')
+        return os.getenv('1_PRIV_KEY')
     elif (from_address == os.getenv('2_PUB_KEY')):
-        private_key = os.getenv('2_PRIV_KEY')
+        return os.getenv('2_PRIV_KEY')
     elif (from_address == os.getenv('3_PUB_KEY')):
-        private_key = os.getenv('3_PRIV_KEY')
+        return os.getenv('3_PRIV_KEY')
+    return ""
+
+
+# Errori del nodo che indicano un nonce locale non più allineato
+NONCE_ERRORS = ("nonce too low", "replacement transaction underpriced")
+NONCE_RETRIES = 3
+
+
+class NonceManager:
+    """
+    In-process nonce allocator, one counter per validator address.
+
+    The counter is seeded once from the pending transaction count and then
+    handed out under a per-address lock, so overlapping notarizations of the
+    same validator get distinct nonces without an RPC round trip each.
+    """
+
+    def __init__(self):
+        self._next_nonce = {}
+        self._locks = {}
 
-    signed_transaction = web3.eth.account.sign_transaction(
-        transaction_data, private_key=private_key)
-    tx_hash = web3.eth.send_raw_transaction(signed_transaction.rawTransaction)
-    receipt = web3.eth.wait_for_transaction_receipt(tx_hash)
-    block_number = receipt['blockNumber']
+    def _lock(self, address):
+        return self._locks.setdefault(address, asyncio.Lock())
 
-    block = web3.eth.get_block(block_number)
-    timestamp = block['timestamp']
-    print('Transazione POST completata. Risposta:', receipt)
-    return {"receipt": receipt, "timestamp": timestamp}
+    async def allocate(self, address):
+        async with self._lock(address):
+            if address not in self._next_nonce:
+                self._next_nonce[address] = await web3.eth.get_transaction_count(address, 'pending')
+            nonce = self._next_nonce[address]
+            self._next_nonce[address] = nonce + 1
+            return nonce
+
+    async def resync(self, address):
+        async with self._lock(address):
+            self._next_nonce[address] = await web3.eth.get_transaction_count(address, 'pending')
+
+
+nonce_manager = NonceManager()
+
+
+def is_nonce_error(error):
+    message = str(error).lower()
+    return any(nonce_error in message for nonce_error in NONCE_ERRORS)
+
+
+async def send_transaction(from_address, contract_function):
+    private_key = get_private_key(from_address)
+    for attempt in range(NONCE_RETRIES):
+        nonce = await nonce_manager.allocate(from_address)
+        try:
+            transaction_data = await contract_function.build_transaction({
+                'from': from_address,
+                'chainId': 10002,
+                'nonce': nonce
+            })
+            signed_transaction = web3.eth.account.sign_transaction(
+                transaction_data, private_key=private_key)
+            tx_hash = await web3.eth.send_raw_transaction(signed_transaction.rawTransaction)
+            break
+        except Exception as e:
+            # Riallinea il contatore (anche per non lasciare buchi nei nonce)
+            await nonce_manager.resync(from_address)
+            if not is_nonce_error(e) or attempt == NONCE_RETRIES - 1:
+                raise
+    print('Transazione POST inviata:', tx_hash.hex())
+    return tx_hash
+
+
+async def post_temperature(from_address, device_id, temperature):
+    return await send_transaction(
+        from_address, contract.get().functions.recordTemperature(device_id, temperature))
 
 
 async def post_humidity(from_address, device_id, humidity):
-    nonce = web3.eth.get_transaction_count(from_address)
-    print(nonce)
+    return await send_transaction(
+        from_address, contract.get().functions.recordHumidity(device_id, humidity))
 
-    transaction_data = contract.functions.recordHumidity(device_id, humidity).build_transaction({
-        'from': from_address,
-        'chainId': 10002,
-        'nonce': nonce
-    })
 
-    private_key = ""
-    if (from_address == os.getenv('1_PUB_KEY')):
-        private_key = os.getenv('1_PRIV_KEY')
-    elif (from_address == os.getenv('2_PUB_KEY')):
-        private_key = os.getenv('2_PRIV_KEY')
-    elif (from_address == os.getenv('3_PUB_KEY')):
-        private_key = os.getenv('3_PRIV_KEY')
-
-    signed_transaction = web3.eth.account.sign_transaction(
-        transaction_data, private_key=private_key)
-    tx_hash = web3.eth.send_raw_transaction(signed_transaction.rawTransaction)
-    receipt = web3.eth.wait_for_transaction_receipt(tx_hash)
-    block_number = receipt['blockNumber']
-
-    block = web3.eth.get_block(block_number)
-    timestamp = block['timestamp']
-    print('Transazione POST completata. Risposta:', receipt)
-    return {"receipt": receipt, "timestamp": timestamp}
+async def post_batch(from_address, readings):
+    """Notarize a list of (device_id, kind, value) readings in one transaction"""
+    device_ids = [device_id for device_id, kind, value in readings]
+    kinds = [READING_KINDS[kind] for device_id, kind, value in readings]
+    values = [value for device_id, kind, value in readings]
+
+    return await send_transaction(
+        from_address, contract.get().functions.recordBatch(device_ids, kinds, values))
+
+
+def batch_inclusion(receipt, count):
+    """
+    Map a recordBatch receipt back to its readings: an entry is False for the
+    readings the contract rejected with a RecordRejected event.
+    """
+    if receipt['status'] != 1:
+        return [False] * count
+    rejected = set()
+    for event in contract.get().events.RecordRejected().process_receipt(receipt, errors=DISCARD):
+        rejected.add(event['args']['index'])
+    return [index not in rejected for index in range(count)]
+
+
+async def anchor_root(from_address, root, count):
+    return await send_transaction(
+        from_address, contract.get().functions.anchorRoot(root, count))
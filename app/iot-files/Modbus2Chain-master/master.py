@@ -1,34 +1,74 @@
 import os
+import sys
 import time
+import json
+import struct
 import argparse
+import contextlib
 from dotenv import load_dotenv
-from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
-from cryptography.hazmat.primitives import serialization
-from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
-from cryptography.hazmat.primitives import padding
-from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms
 from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
-from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
-from cryptography.hazmat.primitives import serialization
-from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
 from package.umodbus import tcp
 import hashlib
-import binascii
 load_dotenv()
 
 
-# Initialize the encryptor and the decryptor
-hex_string = os.getenv('NONCE')
-nonce = binascii.unhexlify(hex_string)
+# Key material, derived once (nonces are generated per message, see RegisterCipher)
 encryption_key = hashlib.sha256(os.getenv("ENCRYPTION_KEY").encode()).digest() 
 
+# ChaCha20 over blocks of 16-bit register words.
+# Every message gets its own 16-byte nonce: 32-bit block counter (0), a
+# random 4-byte session id drawn once per process and a 64-bit message
+# counter seeded from time_ns(). The session id partitions the nonce space
+# between daemons running at the same time on a gateway (max_sessions > 1),
+# the counter keeps growing across restarts of the same daemon. The nonce
+# travels with the ciphertext in the reply record, see encrypt_and_write.
+# Values are packed with fixed-width '>H' words, one per register, and a
+# whole block is encrypted with a single cipher context.
+class RegisterCipher:
+    NONCE_FORMAT = struct.Struct('<I4sQ')
+
+    def __init__(self, key, session_id=None, counter=None):
+        self._key = key
+        self._session_id = os.urandom(4) if session_id is None else session_id
+        self._counter = time.time_ns() if counter is None else counter
+        self._formats = {}
+        self._backend = default_backend()
+
+    def _format(self, count):
+        fmt = self._formats.get(count)
+        if fmt is None:
+            fmt = self._formats[count] = struct.Struct('>{}H'.format(count))
+        return fmt
+
+    def _apply(self, nonce, data):
+        return Cipher(algorithms.ChaCha20(self._key, nonce), mode=None,
+                      backend=self._backend).encryptor().update(data)
+
+    def encrypt_block(self, values):
+        """Encrypt a list of register values; returns (nonce, words)"""
+        nonce = self.NONCE_FORMAT.pack(0, self._session_id, self._counter)
+        self._counter += 1
+        fmt = self._format(len(values))
+        return nonce, list(fmt.unpack(self._apply(nonce, fmt.pack(*values))))
+
+    def decrypt_block(self, nonce, words):
+        fmt = self._format(len(words))
+        return list(fmt.unpack(self._apply(nonce, fmt.pack(*words))))
+
+register_cipher = RegisterCipher(encryption_key)
+
 
 slave_tcp_port = int(os.getenv("SLAVE_TCP_PORT")) 
 slave_ip = os.getenv("SLAVE_IP")
 
+# Diagnostic output on stderr, enabled with -v or MASTER_VERBOSE=1
+verbose = os.getenv("MASTER_VERBOSE") == "1"
+
+def log(message):
+    if verbose:
+        print(message, file=sys.stderr)
+
 register_definitions = {
     "COILS": {
         "MOVEMENT_HANDLE": {
@@ -83,16 +123,21 @@ register_definitions = {
     }
 }
 
+# Read requests kept in flight per connection by the batch API; leave 1 for
+# slaves running the umodbus TCPServer, which handles one request per recv
+pipeline_depth = int(os.getenv("MODBUS_PIPELINE_DEPTH", "1"))
+
 def connect_to_slave():
     host = tcp.TCP(
            slave_ip=slave_ip,
            slave_port=slave_tcp_port,
-           timeout=30) 
+           timeout=30,
+           max_outstanding=pipeline_depth) 
     return host
 
 # Function to send a write request to registers
 def write_to_register(host,register_type, register_name, data_to_write):
-    print("register_type {}, write to reg" .format(register_name))
+    log("register_type {}, write to reg" .format(register_name))
     register_address = register_definitions[register_type][register_name]['register']
     register_qty = register_definitions[register_type][register_name]['len']
 
@@ -105,8 +150,7 @@ def write_to_register(host,register_type, register_name, data_to_write):
         register_value=data_to_write,
         signed=False)
   
-    time.sleep(1)
-    print('Result of setting {} {}: {}'.format(register_type, register_name, operation_status))
+    log('Result of setting {} {}: {}'.format(register_type, register_name, operation_status))
 
 # Function to send a read request to registers
 def read_from_register(host,register_type, register_name):
@@ -136,7 +180,7 @@ def read_from_register_coils(host,register_type, register_name):
 
 # Function to send a write request to registers [COILS]
 def write_to_register_coils(host,register_type, register_name, data_to_write):
-    print("register_type {}, write to reg" .format(register_name))
+    log("register_type {}, write to reg" .format(register_name))
     register_address = register_definitions[register_type][register_name]['register']
     register_qty = register_definitions[register_type][register_name]['len']
 
@@ -147,92 +191,283 @@ def write_to_register_coils(host,register_type, register_name, data_to_write):
         output_value=data_to_write
         )
   
-    print('Result of setting {} {}: {}'.format(register_type, register_name, operation_status))
+    log('Result of setting {} {}: {}'.format(register_type, register_name, operation_status))
     
 def get_sensors_data(host,register_type, register_name):
-    read_from_register(host,register_type, register_name)
     return read_from_register(host,register_type, register_name)
+
+# Trigger-and-fetch in one Modbus transaction: the slave runs the on_get
+# callback of the first register of a read (which samples the sensor and
+# stores the value) before building the response, so reading from the
+# trigger register up to the value register returns the fresh sample.
+def trigger_and_fetch(host, trigger_name, value_name):
+    trigger = register_definitions['HREGS'][trigger_name]
+    value = register_definitions['HREGS'][value_name]
+    offset = value['register'] - trigger['register']
+    if offset < 0:
+        raise ValueError('{} must follow {}'.format(value_name, trigger_name))
+    data = host.read_holding_registers(
+        slave_addr=int(os.getenv("SLAVE_ADDRESS")),
+        starting_addr=trigger['register'],
+        register_qty=offset + value['len'],
+        signed=False)
+    return data[offset]
     
-# Function to encrypt and encode data
+# Function to encrypt and encode a register value: returns the hex nonce
+# and the encrypted 16-bit word
 def encrypt_and_encode(data_to_encrypt):
-    cipher = Cipher(algorithms.ChaCha20(encryption_key, nonce), mode=None, backend=default_backend())
-    encryptor = cipher.encryptor()
-    # Convert the int data in array of bytes
-    data_bytes = int_to_bytes(data_to_encrypt)
-    ciphertext = encryptor.update(data_bytes) + encryptor.finalize()
-    return int.from_bytes(ciphertext, byteorder='big')
+    nonce, words = register_cipher.encrypt_block([data_to_encrypt])
+    return nonce.hex(), words[0]
 
-#Decrypts and decodes the encoded data.
-def decrypt_and_decode(encoded_data):
-    cipher = Cipher(algorithms.ChaCha20(encryption_key, nonce), mode=None, backend=default_backend())
-    decryptor = cipher.decryptor()
+#Decrypts and decodes an encrypted word given the hex nonce it was sent with.
+def decrypt_and_decode(nonce, encoded_data):
+    return register_cipher.decrypt_block(bytes.fromhex(nonce), [encoded_data])[0]
 
-    # Convert the int data to bytes
-    ciphertext = int_to_bytes(encoded_data)
+# Encrypt a value, write it to a holding register and describe it in
+# details["encrypted"] (register, ciphertext, nonce) for the reply record
+def encrypt_and_write(host, register_name, value, details=None):
+    nonce, ciphertext = encrypt_and_encode(int(value))
+    write_to_register(host, 'HREGS', register_name, ciphertext)
+    if details is not None:
+        details["encrypted"] = {"register": register_name, "ciphertext": ciphertext, "nonce": nonce}
     
-    # Decrypt the ciphertext
-    decrypted_data_bytes = decryptor.update(ciphertext) + decryptor.finalize()
-    # Convert the decrypted bytes to an integer
-    decrypted_data = int.from_bytes(decrypted_data_bytes, byteorder='big')
-    return decrypted_data
 
-def int_to_bytes(value):
-    return value.to_bytes((value.bit_length() + 7) // 8, 'big')
+# Modbus limit of registers per read request (FC 03/04)
+MAX_READ_QTY = 125
+# Unused registers tolerated between two ranges merged in one request
+MAX_READ_GAP = int(os.getenv("MAX_READ_GAP", "8"))
 
-def bytes_to_int(bytes_data):
-    return int.from_bytes(bytes_data, 'big')
-    
+# Read planner: merges the address ranges of the requested registers into
+# the fewest read requests, as [(start, qty, [names])], without exceeding
+# max_qty registers per request. Note that the slave only runs the on_get
+# callback of the first register of each request.
+def plan_reads(register_type, register_names, max_gap=MAX_READ_GAP, max_qty=MAX_READ_QTY):
+    spans = sorted((register_definitions[register_type][name]['register'],
+                    register_definitions[register_type][name]['register'] + register_definitions[register_type][name]['len'],
+                    name) for name in register_names)
+    plan = []
+    for start, end, name in spans:
+        if plan and start - plan[-1][1] <= max_gap and max(end, plan[-1][1]) - plan[-1][0] <= max_qty:
+            plan[-1][1] = max(end, plan[-1][1])
+            plan[-1][2].append(name)
+        else:
+            plan.append([start, end, [name]])
+    return [(start, end - start, names) for start, end, names in plan]
+
+# Execute a read plan (its requests pipelined by the batch API) and slice
+# the results back per register name (a single value for one-register
+# entries, a list otherwise)
+def read_registers(host, register_type, register_names):
+    readers = {'HREGS': host.read_holding_registers_batch, 'IREGS': host.read_input_registers_batch}
+    plan = plan_reads(register_type, register_names)
+    blocks = readers[register_type](
+        slave_addr=int(os.getenv("SLAVE_ADDRESS")),
+        ranges=[(start, qty) for start, qty, names in plan],
+        signed=False)
+    values = {}
+    for (start, qty, names), data in zip(plan, blocks):
+        for name in names:
+            offset = register_definitions[register_type][name]['register'] - start
+            length = register_definitions[register_type][name]['len']
+            values[name] = data[offset] if length == 1 else list(data[offset:offset + length])
+    return values
+
+def get_snapshot(host=None, details=None):
+    if host is None:
+        host = connect_to_slave()
+
+    # Every holding and input register, in one request per register type
+    snapshot = read_registers(host, 'HREGS', register_definitions['HREGS'])
+    snapshot.update(read_registers(host, 'IREGS', register_definitions['IREGS']))
+    return snapshot
 
-def get_temp_from_slave():
-    host= connect_to_slave()
+def get_temp_from_slave(host=None, details=None):
+    if host is None:
+        host = connect_to_slave()
     
-    #Take the temperature from DHT11 and encrypt
-    read_from_register(host,'HREGS', 'TEMPERATURE_HREG')[0]
-    temp=read_from_register(host,'HREGS', 'TEMP_HREG_TEMPERTURE')[0]
-    encrypted_temperature=encrypt_and_encode(int(temp))
+    #Take the temperature from DHT11 (registers 93..96)
+    temp=trigger_and_fetch(host,'TEMPERATURE_HREG', 'TEMP_HREG_TEMPERTURE')
     
     #Write to the register the encrypted temperature
-    write_to_register(host,'HREGS', 'TEMPERATURE_HREG', encrypted_temperature)
+    encrypt_and_write(host, 'TEMPERATURE_HREG', temp, details)
     
-    print(temp)
+    return temp
     
-def get_hum_from_slave():
-    host= connect_to_slave()
+def get_hum_from_slave(host=None, details=None):
+    if host is None:
+        host = connect_to_slave()
     
-    #Take the temperature from DHT11 and encrypt
-    read_from_register(host,'HREGS', 'HUMIDITY_HREG')[0]
-    hum=read_from_register(host,'HREGS', 'TEMP_HREG_HUMIDITY')[0]
-    encrypted_humidity=encrypt_and_encode(int(hum))
+    #Take the humidity from DHT11 (registers 94..95)
+    hum=trigger_and_fetch(host,'HUMIDITY_HREG', 'TEMP_HREG_HUMIDITY')
     
-    #Write to the register the encrypted temperature
-    write_to_register(host,'HREGS', 'HUMIDITY_HREG', encrypted_humidity)
+    #Write to the register the encrypted humidity
+    encrypt_and_write(host, 'HUMIDITY_HREG', hum, details)
     
-    print(hum)
+    return hum
 
-def detects_movement():
-    host= connect_to_slave()
+def detects_movement(host=None, details=None):
+    if host is None:
+        host = connect_to_slave()
     
-    #Take the temperature from DHT11 and encrypt
-    read_from_register_coils(host,'COILS', 'MOVEMENT_HANDLE')[0]
+    #Read the movement coil (the on_get callback samples the sensor)
     mov=read_from_register_coils(host,'COILS', 'MOVEMENT_HANDLE')[0]
     
-    #Write to the register the encrypted temperature
+    #Write back the movement state
     write_to_register_coils(host,'COILS', 'MOVEMENT_HANDLE', mov)
     
-    print(mov)
+    return int(mov)
+
+# Command name -> (function, register the returned value comes from)
+COMMANDS = {
+    'get_temp_from_slave': (get_temp_from_slave, 'TEMP_HREG_TEMPERTURE'),
+    'get_hum_from_slave': (get_hum_from_slave, 'TEMP_HREG_HUMIDITY'),
+    'detects_movement': (detects_movement, 'MOVEMENT_HANDLE'),
+    'get_snapshot': (get_snapshot, None)
+}
+
+# Pool of open Modbus TCP connections, a list of idle hosts per slave.
+# The slave firmware (TCPServer) drops its previous client when a new one is
+# accepted, so by default at most one connection per slave is kept open.
+class SlavePool:
+    def __init__(self, max_per_slave=1):
+        self.max_per_slave = max_per_slave
+        self._idle = {}
+
+    def acquire(self, ip, port):
+        idle = self._idle.get((ip, port))
+        if idle:
+            return idle.pop()
+        return tcp.TCP(slave_ip=ip, slave_port=port, timeout=30, max_outstanding=pipeline_depth)
+
+    def release(self, ip, port, host):
+        idle = self._idle.setdefault((ip, port), [])
+        if len(idle) < self.max_per_slave:
+            idle.append(host)
+        else:
+            host.close()
+
+    def discard(self, host):
+        if host is not None:
+            host.close()
+
+    def close(self):
+        for idle in self._idle.values():
+            for host in idle:
+                host.close()
+        self._idle.clear()
+
+# Parse an optional "ip[:port]" target, falling back to the slave in the .env
+def parse_target(target):
+    if not target:
+        return slave_ip, slave_tcp_port
+    ip, _, port = target.partition(':')
+    return ip, int(port) if port else slave_tcp_port
+
+# One compact JSON record per request: {"ok", "command", "value",
+# "register", "latency_ms", "error"}, plus whatever the command put in
+# details (e.g. "encrypted" with the ciphertext and its nonce)
+def make_record(command, value=None, error=None, started=None, details=None):
+    register = COMMANDS[command][1] if command in COMMANDS else None
+    latency = None if started is None else round((time.perf_counter() - started) * 1000, 3)
+    record = {"ok": error is None, "command": command, "value": value,
+              "register": register, "latency_ms": latency, "error": error}
+    if details:
+        record.update(details)
+    return json.dumps(record, separators=(',', ':'))
+
+# Run a command on an open connection and return its record
+def run_command(command, host):
+    started = time.perf_counter()
+    details = {}
+    try:
+        with contextlib.redirect_stdout(sys.stderr):
+            value = COMMANDS[command][0](host, details)
+    except Exception as e:
+        return make_record(command, error=' '.join(str(e).split()), started=started), False
+    return make_record(command, value=value, started=started, details=details), True
+
+# Long-lived master daemon: reads one command per line from stdin
+# ("<command> [ip[:port]]") and answers with one JSON record per line on
+# stdout (see make_record). Diagnostics, if enabled, go to stderr so that
+# stdout only carries the protocol.
+def serve():
+    pool = SlavePool()
+    out = sys.stdout
+    try:
+        for line in sys.stdin:
+            parts = line.split()
+            if not parts:
+                continue
+            command = parts[0]
+            if command == 'quit':
+                break
+            if command == 'ping':
+                reply = make_record(command, value='pong')
+            elif command not in COMMANDS:
+                reply = make_record(command, error='unknown command {}'.format(command))
+            else:
+                started = time.perf_counter()
+                host = None
+                try:
+                    ip, port = parse_target(parts[1] if len(parts) > 1 else None)
+                    with contextlib.redirect_stdout(sys.stderr):
+                        host = pool.acquire(ip, port)
+                except Exception as e:
+                    reply = make_record(command, error=' '.join(str(e).split()), started=started)
+                else:
+                    reply, ok = run_command(command, host)
+                    if ok:
+                        pool.release(ip, port, host)
+                    else:
+                        # Drop the connection, the next request reconnects
+                        pool.discard(host)
+            out.write(reply + '\n')
+            out.flush()
+    finally:
+        pool.close()
+
+# Latency benchmark of a command on one open connection: one JSON record
+# with min/p50/p95/max in milliseconds and whether p95 meets the target
+def bench(command, iterations, target_ms):
+    host = connect_to_slave()
+    latencies = []
+    try:
+        for _ in range(iterations):
+            started = time.perf_counter()
+            with contextlib.redirect_stdout(sys.stderr):
+                COMMANDS[command][0](host)
+            latencies.append((time.perf_counter() - started) * 1000)
+    finally:
+        host.close()
+    latencies.sort()
+    p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+    print(json.dumps({"command": command, "iterations": iterations,
+                      "min_ms": round(latencies[0], 3),
+                      "p50_ms": round(latencies[len(latencies) // 2], 3),
+                      "p95_ms": round(p95, 3), "max_ms": round(latencies[-1], 3),
+                      "target_ms": target_ms, "met": p95 <= target_ms},
+                     separators=(',', ':')))
+    return 0 if p95 <= target_ms else 1
 
 def main():
+    global verbose
     parser = argparse.ArgumentParser(description='Esegui una funzione specifica.')
-    parser.add_argument('funzione', choices=['get_temp_from_slave','get_hum_from_slave','detects_movement'], help='Nome della funzione da eseguire')
+    parser.add_argument('funzione', choices=list(COMMANDS) + ['serve','bench'], help='Nome della funzione da eseguire')
+    parser.add_argument('comando', nargs='?', default='get_temp_from_slave', choices=list(COMMANDS), help='Comando misurato da bench')
+    parser.add_argument('-n', '--iterations', type=int, default=50, help='Numero di letture eseguite da bench')
+    parser.add_argument('--target-ms', type=float, default=float(os.getenv("MASTER_LATENCY_TARGET_MS", "250")), help='Latenza p95 attesa da bench, in millisecondi')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Stampa i messaggi diagnostici su stderr')
     args = parser.parse_args()
+    verbose = verbose or args.verbose
 
-    if args.funzione == 'get_temp_from_slave':
-        return get_temp_from_slave()
-    elif args.funzione == 'get_hum_from_slave':
-        return get_hum_from_slave()
-    elif args.funzione == 'detects_movement':
-        return detects_movement()
+    if args.funzione == 'serve':
+        return serve()
+    if args.funzione == 'bench':
+        return bench(args.comando, args.iterations, args.target_ms)
+    reply, ok = run_command(args.funzione, connect_to_slave())
+    print(reply)
+    return 0 if ok else 1
 
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
     
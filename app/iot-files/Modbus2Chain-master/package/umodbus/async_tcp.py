@@ -0,0 +1,435 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2019, Pycom Limited.
+#
+# This software is licensed under the GNU GPL version 3 or any
+# later version, with permitted additional terms. For more information
+# see the Pycom Licence v1.0 document supplied with this file, or
+# available at https://www.pycom.io/opensource/licensing
+#
+
+# system packages
+import asyncio
+import struct
+
+# custom packages
+from . import functions
+from .const import *
+from .tcp import TCP
+
+# typing not natively supported on MicroPython
+from .typing import List, Optional, Tuple, Union
+
+
+class TransactionIDError(ValueError):
+    """Response of another request: the stream is out of sync"""
+
+
+class AsyncTCP(object):
+    """
+    asyncio Modbus TCP client, one instance per slave.
+
+    The connection is opened on the first request and reopened after a
+    connection error or a timeout, up to `retries` times per request.
+    Requests on the same instance are serialized; requests to different
+    slaves run concurrently on the same event loop, e.g.
+
+        clients = [AsyncTCP(ip, timeout=2.0) for ip in slave_ips]
+        values = await asyncio.gather(
+            *[client.read_holding_registers(1, 93, 4) for client in clients],
+            return_exceptions=True)
+
+    PDUs are built and checked with :py:mod:`umodbus.functions` and the
+    MBAP header code of :py:class:`umodbus.tcp.TCP`.
+
+    :param      slave_ip:    IP of the slave
+    :type       slave_ip:    str
+    :param      slave_port:  Port of the slave
+    :type       slave_port:  int
+    :param      timeout:     Timeout of connection and request, in seconds
+    :type       timeout:     float
+    :param      retries:     Reconnections attempted per request
+    :type       retries:     int
+    """
+    def __init__(self,
+                 slave_ip: str,
+                 slave_port: int = 502,
+                 timeout: float = 5.0,
+                 retries: int = 1):
+        self.slave_ip = slave_ip
+        self.slave_port = slave_port
+        self.timeout = timeout
+        self.retries = retries
+        self.trans_id_ctr = 0
+        self.reconnects = 0
+        self._reader = None
+        self._writer = None
+        self._lock = None
+
+    _create_mbap_hdr = TCP._create_mbap_hdr
+    _validate_resp_hdr = TCP._validate_resp_hdr
+
+    @property
+    def connected(self) -> bool:
+        """
+        Get the connection status.
+
+        :returns:   True if the connection is open, False otherwise
+        :rtype:     bool
+        """
+        return self._writer is not None and not self._writer.is_closing()
+
+    async def connect(self) -> None:
+        """Open the connection to the slave"""
+        self._reader, self._writer = await asyncio.wait_for(
+            asyncio.open_connection(self.slave_ip, self.slave_port),
+            self.timeout)
+
+    async def close(self) -> None:
+        """Close the connection to the slave"""
+        writer = self._abort()
+        if writer is not None:
+            try:
+                await writer.wait_closed()
+            except OSError:
+                pass
+
+    def _abort(self):
+        """
+        Drop the connection without waiting, usable while being cancelled.
+
+        :returns:   The closed stream writer, if any
+        :rtype:     Optional[asyncio.StreamWriter]
+        """
+        writer, self._reader, self._writer = self._writer, None, None
+        if writer is not None:
+            writer.close()
+        return writer
+
+    async def _exchange(self,
+                        slave_addr: int,
+                        modbus_pdu: bytes,
+                        count: bool) -> bytes:
+        """
+        Send a modbus message and receive its complete response frame.
+
+        :param      slave_addr:  The slave identifier
+        :type       slave_addr:  int
+        :param      modbus_pdu:  The modbus PDU
+        :type       modbus_pdu:  bytes
+        :param      count:       The count
+        :type       count:       bool
+
+        :returns:   Modbus data
+        :rtype:     bytes
+        """
+        mbap_hdr, trans_id = self._create_mbap_hdr(slave_addr=slave_addr,
+                                                   modbus_pdu=modbus_pdu)
+        self._writer.write(mbap_hdr + modbus_pdu)
+        await self._writer.drain()
+
+        header = await self._reader.readexactly(MBAP_HDR_LENGTH)
+        rec_tid, length = struct.unpack_from('>H2xH', header, 0)
+        if rec_tid != trans_id:
+            raise TransactionIDError('wrong transaction ID')
+        if length < 2 or MBAP_HDR_LENGTH - 1 + length > MBAP_MAX_ADU_LENGTH:
+            raise ValueError('invalid MBAP length: {:d}'.format(length))
+        response = header + await self._reader.readexactly(length - 1)
+
+        return self._validate_resp_hdr(response=response,
+                                       trans_id=trans_id,
+                                       slave_addr=slave_addr,
+                                       function_code=modbus_pdu[0],
+                                       count=count)
+
+    async def _send_receive(self,
+                            slave_addr: int,
+                            modbus_pdu: bytes,
+                            count: bool) -> bytes:
+        """
+        Send a modbus message and receive the reponse, reconnecting on
+        connection errors and timeouts.
+
+        :param      slave_addr:  The slave identifier
+        :type       slave_addr:  int
+        :param      modbus_pdu:  The modbus PDU
+        :type       modbus_pdu:  bytes
+        :param      count:       The count
+        :type       count:       bool
+
+        :returns:   Modbus data
+        :rtype:     bytes
+        """
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+
+        async with self._lock:
+            for attempt in range(self.retries + 1):
+                try:
+                    if not self.connected:
+                        if attempt:
+                            self.reconnects += 1
+                        await self.connect()
+                    return await asyncio.wait_for(
+                        self._exchange(slave_addr, modbus_pdu, count),
+                        self.timeout)
+                except (OSError, asyncio.TimeoutError,
+                        asyncio.IncompleteReadError):
+                    # a late or partial response would desync the stream
+                    await self.close()
+                    if attempt == self.retries:
+                        raise
+                except asyncio.CancelledError:
+                    # the response of the cancelled request is still unread
+                    self._abort()
+                    raise
+                except TransactionIDError:
+                    self._abort()
+                    raise
+
+    async def read_coils(self,
+                         slave_addr: int,
+                         starting_addr: int,
+                         coil_qty: int) -> List[bool]:
+        """
+        Read coils (COILS).
+
+        :param      slave_addr:     The slave address
+        :type       slave_addr:     int
+        :param      starting_addr:  The coil starting address
+        :type       starting_addr:  int
+        :param      coil_qty:       The amount of coils to read
+        :type       coil_qty:       int
+
+        :returns:   State of read coils as list
+        :rtype:     List[bool]
+        """
+        modbus_pdu = functions.read_coils(starting_address=starting_addr,
+                                          quantity=coil_qty)
+
+        response = await self._send_receive(slave_addr=slave_addr,
+                                            modbus_pdu=modbus_pdu,
+                                            count=True)
+
+        return functions.bytes_to_bool(byte_list=response, bit_qty=coil_qty)
+
+    async def read_discrete_inputs(self,
+                                   slave_addr: int,
+                                   starting_addr: int,
+                                   input_qty: int) -> List[bool]:
+        """
+        Read discrete inputs (ISTS).
+
+        :param      slave_addr:     The slave address
+        :type       slave_addr:     int
+        :param      starting_addr:  The discrete input starting address
+        :type       starting_addr:  int
+        :param      input_qty:      The amount of discrete inputs to read
+        :type       input_qty:      int
+
+        :returns:   State of read discrete inputs as list
+        :rtype:     List[bool]
+        """
+        modbus_pdu = functions.read_discrete_inputs(
+            starting_address=starting_addr,
+            quantity=input_qty)
+
+        response = await self._send_receive(slave_addr=slave_addr,
+                                            modbus_pdu=modbus_pdu,
+                                            count=True)
+
+        return functions.bytes_to_bool(byte_list=response, bit_qty=input_qty)
+
+    async def read_holding_registers(self,
+                                     slave_addr: int,
+                                     starting_addr: int,
+                                     register_qty: int,
+                                     signed: bool = True) -> Tuple[int, ...]:
+        """
+        Read holding registers (HREGS).
+
+        :param      slave_addr:     The slave address
+        :type       slave_addr:     int
+        :param      starting_addr:  The holding register starting address
+        :type       starting_addr:  int
+        :param      register_qty:   The amount of holding registers to read
+        :type       register_qty:   int
+        :param      signed:         Indicates if signed
+        :type       signed:         bool
+
+        :returns:   State of read holding register as tuple
+        :rtype:     Tuple[int, ...]
+        """
+        modbus_pdu = functions.read_holding_registers(
+            starting_address=starting_addr,
+            quantity=register_qty)
+
+        response = await self._send_receive(slave_addr=slave_addr,
+                                            modbus_pdu=modbus_pdu,
+                                            count=True)
+
+        return functions.to_short(byte_array=response, signed=signed)
+
+    async def read_input_registers(self,
+                                   slave_addr: int,
+                                   starting_addr: int,
+                                   register_qty: int,
+                                   signed: bool = True) -> Tuple[int, ...]:
+        """
+        Read input registers (IREGS).
+
+        :param      slave_addr:     The slave address
+        :type       slave_addr:     int
+        :param      starting_addr:  The input register starting address
+        :type       starting_addr:  int
+        :param      register_qty:   The amount of input registers to read
+        :type       register_qty:   int
+        :param      signed:         Indicates if signed
+        :type       signed:         bool
+
+        :returns:   State of read input register as tuple
+        :rtype:     Tuple[int, ...]
+        """
+        modbus_pdu = functions.read_input_registers(
+            starting_address=starting_addr,
+            quantity=register_qty)
+
+        response = await self._send_receive(slave_addr=slave_addr,
+                                            modbus_pdu=modbus_pdu,
+                                            count=True)
+
+        return functions.to_short(byte_array=response, signed=signed)
+
+    async def write_single_coil(self,
+                                slave_addr: int,
+                                output_address: int,
+                                output_value: Union[int, bool]) -> bool:
+        """
+        Update a single coil.
+
+        :param      slave_addr:      The slave address
+        :type       slave_addr:      int
+        :param      output_address:  The output address
+        :type       output_address:  int
+        :param      output_value:    The output value
+        :type       output_value:    Union[int, bool]
+
+        :returns:   Result of operation
+        :rtype:     bool
+        """
+        modbus_pdu = functions.write_single_coil(output_address=output_address,
+                                                 output_value=output_value)
+
+        response = await self._send_receive(slave_addr=slave_addr,
+                                            modbus_pdu=modbus_pdu,
+                                            count=False)
+
+        return functions.validate_resp_data(
+            data=response,
+            function_code=WRITE_SINGLE_COIL,
+            address=output_address,
+            value=output_value,
+            signed=False)
+
+    async def write_single_register(self,
+                                    slave_addr: int,
+                                    register_address: int,
+                                    register_value: int,
+                                    signed: bool = True) -> bool:
+        """
+        Update a single register.
+
+        :param      slave_addr:        The slave address
+        :type       slave_addr:        int
+        :param      register_address:  The register address
+        :type       register_address:  int
+        :param      register_value:    The register value
+        :type       register_value:    int
+        :param      signed:            Indicates if signed
+        :type       signed:            bool
+
+        :returns:   Result of operation
+        :rtype:     bool
+        """
+        modbus_pdu = functions.write_single_register(
+            register_address=register_address,
+            register_value=register_value,
+            signed=signed)
+
+        response = await self._send_receive(slave_addr=slave_addr,
+                                            modbus_pdu=modbus_pdu,
+                                            count=False)
+
+        return functions.validate_resp_data(
+            data=response,
+            function_code=WRITE_SINGLE_REGISTER,
+            address=register_address,
+            value=register_value,
+            signed=signed)
+
+    async def write_multiple_coils(self,
+                                   slave_addr: int,
+                                   starting_address: int,
+                                   output_values: List[Union[int, bool]]) -> bool:
+        """
+        Update multiple coils.
+
+        :param      slave_addr:        The slave address
+        :type       slave_addr:        int
+        :param      starting_address:  The address of the first coil
+        :type       starting_address:  int
+        :param      output_values:     The output values
+        :type       output_values:     List[Union[int, bool]]
+
+        :returns:   Result of operation
+        :rtype:     bool
+        """
+        modbus_pdu = functions.write_multiple_coils(
+            starting_address=starting_address,
+            value_list=output_values)
+
+        response = await self._send_receive(slave_addr=slave_addr,
+                                            modbus_pdu=modbus_pdu,
+                                            count=False)
+
+        return functions.validate_resp_data(
+            data=response,
+            function_code=WRITE_MULTIPLE_COILS,
+            address=starting_address,
+            quantity=len(output_values))
+
+    async def write_multiple_registers(self,
+                                       slave_addr: int,
+                                       starting_address: int,
+                                       register_values: List[int],
+                                       signed: bool = True) -> bool:
+        """
+        Update multiple registers.
+
+        :param      slave_addr:        The slave address
+        :type       slave_addr:        int
+        :param      starting_address:  The starting address
+        :type       starting_address:  int
+        :param      register_values:   The register values
+        :type       register_values:   List[int]
+        :param      signed:            Indicates if signed
+        :type       signed:            bool
+
+        :returns:   Result of operation
+        :rtype:     bool
+        """
+        modbus_pdu = functions.write_multiple_registers(
+            starting_address=starting_address,
+            register_values=register_values,
+            signed=signed)
+
+        response = await self._send_receive(slave_addr=slave_addr,
+                                            modbus_pdu=modbus_pdu,
+                                            count=False)
+
+        return functions.validate_resp_data(
+            data=response,
+            function_code=WRITE_MULTIPLE_REGISTERS,
+            address=starting_address,
+            quantity=len(register_values),
+            signed=signed)
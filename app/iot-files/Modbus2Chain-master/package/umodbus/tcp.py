@@ -22,7 +22,7 @@ from .common import ModbusException
 from .modbus import Modbus
 
 # typing not natively supported on MicroPython
-from .typing import Optional, Tuple, Union
+from .typing import List, Optional, Tuple, Union
 
 
 class ModbusTCP(Modbus):
@@ -73,32 +73,34 @@ class TCP(CommonModbusFunctions):
     :type       slave_port:  int
     :param      timeout:     Socket timeout in seconds
     :type       timeout:     float
+    :param      max_outstanding:  Requests kept in flight by the batch API
+    :type       max_outstanding:  int
     """
     def __init__(self,
                  slave_ip: str,
                  slave_port: int = 502,
-                 timeout: float = 5.0):
+                 timeout: float = 5.0,
+                 max_outstanding: int = 1):
         self._sock = socket.socket()
         self.trans_id_ctr = 0
+        self.max_outstanding = max(1, max_outstanding)
+        # receive buffer sized for the largest response, reused by every read
+        self._rx_buf = bytearray(MBAP_MAX_ADU_LENGTH)
+        self._rx_view = memoryview(self._rx_buf)
 
-        
-        addr_info_list = socket.getaddrinfo(slave_ip, slave_port)
-        
         # Estrai l'indirizzo IP e la porta dalla prima tupla nella lista
-        first_addr_info = addr_info_list[0]
-        ip = first_addr_info[4][0]
-        port = first_addr_info[4][1]
-
-        print(addr_info_list)
-        print(f"Indirizzo IP remoto: {ip}")
-        print(f"Porta remota: {port}")
-
-        print(socket.getaddrinfo(slave_ip, slave_port))
         # [(2, 1, 0, '192.168.178.47', ('192.168.178.47', 502))]
-        self._sock.connect((ip,port))
+        ip, port = socket.getaddrinfo(slave_ip, slave_port)[0][4][:2]
+        self._sock.connect((ip, port))
         
         self._sock.settimeout(timeout)
 
+    def close(self) -> None:
+        """Close the socket connection to the slave"""
+        try:
+            self._sock.close()
+        except OSError:
+            pass
 
     def _create_mbap_hdr(self,
                          slave_addr: int,
@@ -120,7 +122,7 @@ class TCP(CommonModbusFunctions):
         # trans_id = random.getrandbits(24) & 0xFFFF
         # use incrementing counter as it's faster
         trans_id = self.trans_id_ctr
-        self.trans_id_ctr += 1
+        self.trans_id_ctr = (self.trans_id_ctr + 1) & 0xFFFF
 
         mbap_hdr = struct.pack(
             '>HHHB', trans_id, 0, len(modbus_pdu) + 1, slave_addr)
@@ -190,16 +192,161 @@ class TCP(CommonModbusFunctions):
         """
         mbap_hdr, trans_id = self._create_mbap_hdr(slave_addr=slave_addr,
                                                    modbus_pdu=modbus_pdu)
-        self._sock.send(mbap_hdr + modbus_pdu)
+        self._sock.sendall(mbap_hdr + modbus_pdu)
 
-        response = self._sock.recv(256)
+        response = self._recv_frame()
         modbus_data = self._validate_resp_hdr(response=response,
                                               trans_id=trans_id,
                                               slave_addr=slave_addr,
                                               function_code=modbus_pdu[0],
                                               count=count)
 
-        return modbus_data
+        return bytes(modbus_data)
+
+    def _recv_into(self, start: int, end: int) -> None:
+        """
+        Fill the receive buffer from start to end, whatever the TCP
+        segmentation of the incoming data.
+
+        :param      start:  The first byte of the buffer to fill
+        :type       start:  int
+        :param      end:    The end of the buffer slice to fill
+        :type       end:    int
+        """
+        while start < end:
+            received = self._sock.recv_into(self._rx_view[start:end],
+                                            end - start)
+            if not received:
+                raise OSError('connection closed by the slave')
+            start += received
+
+    def _recv_frame(self) -> memoryview:
+        """
+        Receive one complete response into the receive buffer: the 7 bytes
+        MBAP header, then exactly length - 1 more bytes as announced by its
+        length field.
+
+        The returned view is only valid until the next receive.
+
+        :returns:   The response ADU
+        :rtype:     memoryview
+        """
+        self._recv_into(0, MBAP_HDR_LENGTH)
+        length = struct.unpack_from('>H', self._rx_buf, 4)[0]
+        end = MBAP_HDR_LENGTH - 1 + length
+        if length < 2 or end > MBAP_MAX_ADU_LENGTH:
+            raise ValueError('invalid MBAP length: {:d}'.format(length))
+        self._recv_into(MBAP_HDR_LENGTH, end)
+
+        return self._rx_view[:end]
+
+    def _send_receive_many(self,
+                           requests: List[Tuple[int, bytes, bool]]) -> List[bytes]:
+        """
+        Send many modbus messages keeping up to max_outstanding of them in
+        flight, and match the responses by transaction ID.
+
+        Only use max_outstanding > 1 with slaves that queue pipelined
+        requests; the TCPServer of this package reads one request per recv.
+
+        :param      requests:  (slave_addr, modbus_pdu, count) per message
+        :type       requests:  List[Tuple[int, bytes, bool]]
+
+        :returns:   Modbus data of every message, in request order
+        :rtype:     List[bytes]
+
+        :raises     ValueError:  The first invalid response, once all the
+                                 responses have been received
+        """
+        results = [None] * len(requests)
+        pending = {}
+        error = None
+        next_request = 0
+
+        while next_request < len(requests) or pending:
+            while (next_request < len(requests) and
+                   len(pending) < self.max_outstanding):
+                slave_addr, modbus_pdu, count = requests[next_request]
+                mbap_hdr, trans_id = self._create_mbap_hdr(
+                    slave_addr=slave_addr,
+                    modbus_pdu=modbus_pdu)
+                self._sock.sendall(mbap_hdr + modbus_pdu)
+                pending[trans_id] = next_request
+                next_request += 1
+
+            response = self._recv_frame()
+            rec_tid = struct.unpack_from('>H', self._rx_buf, 0)[0]
+            if rec_tid not in pending:
+                raise ValueError('wrong transaction ID')
+
+            index = pending.pop(rec_tid)
+            slave_addr, modbus_pdu, count = requests[index]
+            try:
+                results[index] = bytes(self._validate_resp_hdr(
+                    response=response,
+                    trans_id=rec_tid,
+                    slave_addr=slave_addr,
+                    function_code=modbus_pdu[0],
+                    count=count))
+            except ValueError as e:
+                error = error or e
+
+        if error is not None:
+            raise error
+
+        return results
+
+    def read_holding_registers_batch(self,
+                                     slave_addr: int,
+                                     ranges: List[Tuple[int, int]],
+                                     signed: bool = True) -> List[Tuple[int, ...]]:
+        """
+        Read many blocks of holding registers (HREGS), pipelined.
+
+        :param      slave_addr:  The slave address
+        :type       slave_addr:  int
+        :param      ranges:      (starting_addr, register_qty) per block
+        :type       ranges:      List[Tuple[int, int]]
+        :param      signed:      Indicates if signed
+        :type       signed:      bool
+
+        :returns:   State of each block of holding registers
+        :rtype:     List[Tuple[int, ...]]
+        """
+        requests = [(slave_addr,
+                     functions.read_holding_registers(
+                         starting_address=starting_addr,
+                         quantity=register_qty),
+                     True) for starting_addr, register_qty in ranges]
+
+        return [functions.to_short(byte_array=response, signed=signed)
+                for response in self._send_receive_many(requests)]
+
+    def read_input_registers_batch(self,
+                                   slave_addr: int,
+                                   ranges: List[Tuple[int, int]],
+                                   signed: bool = True) -> List[Tuple[int, ...]]:
+        """
+        Read many blocks of input registers (IREGS), pipelined.
+
+        :param      slave_addr:  The slave address
+        :type       slave_addr:  int
+        :param      ranges:      (starting_addr, register_qty) per block
+        :type       ranges:      List[Tuple[int, int]]
+        :param      signed:      Indicates if signed
+        :type       signed:      bool
+
+        :returns:   State of each block of input registers
+        :rtype:     List[Tuple[int, ...]]
+        """
+        requests = [(slave_addr,
+                     functions.read_input_registers(
+                         starting_address=starting_addr,
+                         quantity=register_qty),
+                     True) for starting_addr, register_qty in ranges]
+
+        return [functions.to_short(byte_array=response, signed=signed)
+                for response in self._send_receive_many(requests)]
 
 
 class TCPServer(object):
@@ -0,0 +1,78 @@
+import threading
+import time
+
+
+class LazyResource:
+    """
+    External resource opened on first use.
+
+    get() calls factory() once, under a lock, and returns the cached value; a
+    failed attempt is recorded and retried on the next get(), so a peer that
+    is down at startup does not prevent the process from starting.
+    warm_up() opens the resource in a background thread and health() reports
+    its state, the time the last attempt took and the last error.
+    """
+
+    def __init__(self, name, factory, close=None):
+        self.name = name
+        self._factory = factory
+        self._close = close
+        self._value = None
+        self._ready = False
+        self._error = None
+        self._init_seconds = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        if self._ready:
+            return self._value
+        with self._lock:
+            if not self._ready:
+                started = time.perf_counter()
+                try:
+                    self._value = self._factory()
+                except Exception as e:
+                    self._error = str(e)
+                    raise
+                finally:
+                    self._init_seconds = time.perf_counter() - started
+                self._error = None
+                self._ready = True
+        return self._value
+
+    def warm_up(self):
+        def run():
+            try:
+                self.get()
+            except Exception as e:
+                print("Inizializzazione di {} fallita: {}".format(self.name, e))
+        thread = threading.Thread(target=run, name="warm-up-" + self.name, daemon=True)
+        thread.start()
+        return thread
+
+    @property
+    def ready(self):
+        return self._ready
+
+    def health(self, probe=None):
+        """
+        State of the resource: "up", "down" or "idle" (never used yet).
+        probe(value), if given, is called on an open resource and must raise
+        or return False when the peer is no longer reachable.
+        """
+        status = "up" if self._ready else ("down" if self._error else "idle")
+        error = self._error
+        if self._ready and probe is not None:
+            try:
+                if probe(self._value) is False:
+                    status, error = "down", "probe failed"
+            except Exception as e:
+                status, error = "down", str(e)
+        return {"status": status, "error": error, "init_seconds": self._init_seconds}
+
+    def close(self):
+        with self._lock:
+            if self._ready and self._close is not None:
+                self._close(self._value)
+            self._value = None
+            self._ready = False
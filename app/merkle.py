@@ -0,0 +1,60 @@
+from hexbytes import HexBytes
+from web3 import Web3
+
+
+# Hash di una foglia: una lettura identificata dal suo reading_id
+def leaf_hash(reading_id, device_id, kind, value, timestamp):
+    return Web3.solidity_keccak(['string', 'string', 'string', 'uint256', 'uint256'],
+                                [reading_id, device_id, kind, value, timestamp])
+
+
+# I nodi vengono concatenati in ordine, così la prova non deve indicare il lato
+def node_hash(left, right):
+    if right < left:
+        left, right = right, left
+    return Web3.keccak(left + right)
+
+
+def build_tree(leaves):
+    """
+    Build the Merkle tree of a list of leaf hashes.
+
+    Returns the list of levels, from the leaves up to the root. A node without
+    sibling is promoted unchanged to the next level.
+    """
+    if not leaves:
+        raise ValueError("Cannot build a Merkle tree without leaves")
+    levels = [list(leaves)]
+    while len(levels[-1]) > 1:
+        level = levels[-1]
+        parents = [node_hash(level[i], level[i + 1]) for i in range(0, len(level) - 1, 2)]
+        if len(level) % 2:
+            parents.append(level[-1])
+        levels.append(parents)
+    return levels
+
+
+def merkle_root(levels):
+    return levels[-1][0]
+
+
+def merkle_proof(levels, index):
+    proof = []
+    for level in levels[:-1]:
+        sibling = index ^ 1
+        if sibling < len(level):
+            proof.append(level[sibling])
+        index //= 2
+    return proof
+
+
+def verify_proof(leaf, proof, root):
+    node = leaf
+    for sibling in proof:
+        node = node_hash(node, sibling)
+    return node == root
+
+
+# Verifica di una prova salvata su MongoDB come stringhe esadecimali
+def verify_hex_proof(leaf, proof, root):
+    return verify_proof(HexBytes(leaf), [HexBytes(node) for node in proof], HexBytes(root))
@@ -0,0 +1,434 @@
+import asyncio
+import collections
+import concurrent.futures
+import threading
+import time
+import uuid
+import geth
+import merkle
+
+# Funzioni di notarizzazione per tipo di dato
+NOTARIZE_FUNCTIONS = {
+    "temperature": geth.post_temperature,
+    "humidity": geth.post_humidity
+}
+
+
+class ReceiptWatcher:
+    """
+    Background confirmation watcher.
+
+    Polls the node once per poll_interval and resolves in one pass the tracked
+    hashes of every new block, with receipts fetched concurrently and the
+    timestamp taken from the block header cache. Hashes of recent blocks are
+    remembered for transactions mined before track(). A transaction not mined
+    within timeout seconds fails its future but stays watched, so
+    on_confirmed still runs if it is mined later.
+    """
+
+    def __init__(self, notarizer, poll_interval=1.0, timeout=600.0, recent_size=10000):
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self._notarizer = notarizer
+        self._pending = {}
+        self._confirming = set()
+        self._expired = collections.OrderedDict()
+        self._recent = collections.OrderedDict()
+        self._recent_size = recent_size
+        self._last_block = None
+
+    def track(self, tx_hash, on_confirmed=None):
+        """
+        Track a sent transaction (to be called on the notarizer loop).
+
+        Returns an asyncio future resolved with {"receipt", "timestamp"};
+        on_confirmed, if given, is called with the same dict in a worker thread.
+        """
+        future = self._notarizer.loop.create_future()
+        self._pending[tx_hash] = (future, on_confirmed, time.monotonic())
+        block_number = self._recent.get(tx_hash)
+        if block_number is not None:
+            self._notarizer.loop.create_task(self._resolve(block_number, [tx_hash]))
+        return future
+
+    def is_pending(self, tx_hash):
+        # Resta pending finché la callback di conferma non ha finito
+        return tx_hash in self._pending or tx_hash in self._confirming
+
+    def is_expired(self, tx_hash):
+        return tx_hash in self._expired
+
+    def pending_count(self):
+        return len(self._pending)
+
+    def pending_hashes(self):
+        return [tx_hash.hex() for tx_hash in self._pending]
+
+    async def wait_idle(self):
+        # Attende che ogni transazione tracciata sia confermata e salvata
+        while self._pending or self._confirming:
+            await asyncio.sleep(self.poll_interval)
+
+    async def run(self):
+        while True:
+            try:
+                await self._poll()
+            except Exception as e:
+                print("Errore del watcher delle ricevute: {}".format(e))
+            self._expire()
+            await asyncio.sleep(self.poll_interval)
+
+    async def _poll(self):
+        latest = await geth.web3.eth.block_number
+        if self._last_block is None:
+            self._last_block = latest - 1
+        for number in range(self._last_block + 1, latest + 1):
+            block = await geth.web3.eth.get_block(number)
+            geth.cache_block_header(block)
+            for tx_hash in block['transactions']:
+                self._recent[tx_hash] = number
+            while len(self._recent) > self._recent_size:
+                self._recent.popitem(last=False)
+            hashes = [tx_hash for tx_hash in block['transactions']
+                      if tx_hash in self._pending or tx_hash in self._expired]
+            if hashes:
+                await self._resolve(number, hashes)
+            self._last_block = number
+
+    async def _resolve(self, block_number, hashes):
+        header = await geth.get_block_header(block_number)
+        receipts = await asyncio.gather(
+            *[geth.web3.eth.get_transaction_receipt(tx_hash) for tx_hash in hashes])
+        for tx_hash, receipt in zip(hashes, receipts):
+            result = {"receipt": receipt, "timestamp": header['timestamp']}
+            entry = self._pending.pop(tx_hash, None)
+            if entry is not None:
+                future, on_confirmed, started = entry
+                if not future.done():
+                    future.set_result(result)
+            elif tx_hash in self._expired:
+                # Minata dopo il timeout: il Future è già fallito, la callback no
+                on_confirmed = self._expired.pop(tx_hash)
+            else:
+                continue
+            if on_confirmed is not None:
+                self._confirming.add(tx_hash)
+                self._notarizer.loop.create_task(self._confirm(tx_hash, on_confirmed, result))
+
+    async def _confirm(self, tx_hash, on_confirmed, result):
+        try:
+            await self._notarizer.loop.run_in_executor(None, on_confirmed, result)
+        except Exception as e:
+            print("Errore nel salvataggio della transazione {}: {}".format(tx_hash.hex(), e))
+        finally:
+            self._confirming.discard(tx_hash)
+
+    def _expire(self):
+        now = time.monotonic()
+        for tx_hash, (future, on_confirmed, started) in list(self._pending.items()):
+            if now - started > self.timeout:
+                del self._pending[tx_hash]
+                self._expired[tx_hash] = on_confirmed
+                while len(self._expired) > self._recent_size:
+                    self._expired.popitem(last=False)
+                if not future.done():
+                    future.set_exception(TimeoutError(
+                        "Transaction {} not mined after {} seconds".format(tx_hash.hex(), self.timeout)))
+
+
+class Notarizer:
+    """
+    Asynchronous notarization engine.
+
+    Owns one event loop running in a dedicated thread. Flask handlers push
+    notarization jobs on the submission queue through submit() and get back a
+    concurrent.futures.Future they can wait on (result()) or poll (done()).
+    Up to max_in_flight jobs are processed concurrently; a job completes as
+    soon as its transaction is sent and the ReceiptWatcher takes care of the
+    confirmation in the background.
+    """
+
+    def __init__(self, max_in_flight=32):
+        self.max_in_flight = max_in_flight
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(
+            target=self._run, name="notarizer", daemon=True)
+        self._ready = threading.Event()
+        self._queue = None
+        self._workers = []
+        self.watcher = ReceiptWatcher(self)
+
+    def start(self):
+        self._thread.start()
+        self._ready.wait()
+        return self
+
+    def stop(self):
+        if self._thread.is_alive():
+            asyncio.run_coroutine_threadsafe(self._shutdown(), self._loop)
+            self._thread.join()
+
+    def drain(self, timeout=None):
+        """Wait for the queued jobs and their confirmations; run it before stop()"""
+        if not self._thread.is_alive():
+            return
+        future = asyncio.run_coroutine_threadsafe(self._drain(), self._loop)
+        try:
+            future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            print("Transazioni non confermate entro {} s: {}".format(
+                timeout, ", ".join(self.watcher.pending_hashes())))
+
+    async def _drain(self):
+        await self._queue.join()
+        await self.watcher.wait_idle()
+
+    @property
+    def loop(self):
+        return self._loop
+
+    def _run(self):
+        asyncio.set_event_loop(self._loop)
+        self._queue = asyncio.Queue()
+        self._workers = [self._loop.create_task(self._worker())
+                         for _ in range(self.max_in_flight)]
+        self._workers.append(self._loop.create_task(self.watcher.run()))
+        self._ready.set()
+        self._loop.run_forever()
+        self._loop.close()
+
+    async def _shutdown(self):
+        # Worker, watcher e callback ancora in corso vengono annullati e attesi
+        # prima di fermare il loop
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._loop.stop()
+
+    async def _worker(self):
+        while True:
+            coroutine_function, args, future = await self._queue.get()
+            try:
+                if not future.set_running_or_notify_cancel():
+                    continue
+                try:
+                    result = await coroutine_function(*args)
+                except Exception as e:
+                    future.set_exception(e)
+                else:
+                    future.set_result(result)
+            finally:
+                self._queue.task_done()
+
+    def run(self, coroutine_function, *args):
+        """Queue any coroutine function on the notarizer loop"""
+        future = concurrent.futures.Future()
+        self._loop.call_soon_threadsafe(
+            self._queue.put_nowait, (coroutine_function, args, future))
+        return future
+
+    def submit(self, kind, from_address, device_id, value, on_confirmed=None):
+        """
+        Queue the notarization of a reading. The Future resolves with the hash
+        of the sent transaction; on_confirmed is called with receipt and
+        timestamp once it is mined.
+        """
+        if kind not in NOTARIZE_FUNCTIONS:
+            raise ValueError("Unknown reading kind: {}".format(kind))
+        return self.run(self._notarize, kind, from_address, device_id, value, on_confirmed)
+
+    async def _notarize(self, kind, from_address, device_id, value, on_confirmed):
+        tx_hash = await NOTARIZE_FUNCTIONS[kind](from_address, device_id, value)
+        self.watcher.track(tx_hash, on_confirmed)
+        return tx_hash
+
+    def pending(self):
+        return self._queue.qsize() if self._queue is not None else 0
+
+
+class ReadingBatcher:
+    """
+    Accumulates readings per validator and notarizes them with recordBatch.
+
+    A batch is flushed when it reaches max_size readings or max_delay seconds
+    after its first reading, whichever comes first. add() is thread safe and
+    returns a concurrent.futures.Future resolved with the batch receipt plus
+    the reading's index in the batch and whether it was included.
+    flush_all() submits the open batches and waits for their receipts; it is
+    meant to run at shutdown, before the notarizer stops.
+    """
+
+    def __init__(self, notarizer, max_size=50, max_delay=5.0):
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self._notarizer = notarizer
+        self._batches = {}
+        self._timers = {}
+        self._tasks = set()
+
+    def add(self, from_address, device_id, kind, value):
+        if kind not in geth.READING_KINDS:
+            raise ValueError("Unknown reading kind: {}".format(kind))
+        future = concurrent.futures.Future()
+        self._notarizer.loop.call_soon_threadsafe(
+            self._add, from_address, (device_id, kind, value), future)
+        return future
+
+    def flush_all(self, timeout=None):
+        future = asyncio.run_coroutine_threadsafe(self._flush_all(), self._notarizer.loop)
+        try:
+            future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            print("Notarizzazione dei batch non completata entro {} s".format(timeout))
+
+    def _add(self, from_address, reading, future):
+        batch = self._batches.setdefault(from_address, [])
+        batch.append((reading, future))
+        if len(batch) >= self.max_size:
+            self._flush(from_address)
+        elif len(batch) == 1:
+            self._timers[from_address] = self._notarizer.loop.call_later(
+                self.max_delay, self._flush, from_address)
+
+    async def _flush_all(self):
+        for from_address in list(self._batches):
+            self._flush(from_address)
+        if self._tasks:
+            await asyncio.wait(set(self._tasks))
+
+    def _flush(self, from_address):
+        timer = self._timers.pop(from_address, None)
+        if timer is not None:
+            timer.cancel()
+        batch = self._batches.pop(from_address, [])
+        if batch:
+            task = self._notarizer.loop.create_task(self._submit(from_address, batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _submit(self, from_address, batch):
+        # Le letture il cui Future è stato annullato non vengono notarizzate
+        batch = [(reading, future) for reading, future in batch
+                 if future.set_running_or_notify_cancel()]
+        if not batch:
+            return
+        try:
+            tx_hash = await geth.post_batch(from_address, [reading for reading, future in batch])
+            result = await self._notarizer.watcher.track(tx_hash)
+        except Exception as e:
+            for reading, future in batch:
+                future.set_exception(e)
+            return
+        included = geth.batch_inclusion(result["receipt"], len(batch))
+        for index, (reading, future) in enumerate(batch):
+            future.set_result({"receipt": result["receipt"], "timestamp": result["timestamp"],
+                               "index": index, "included": included[index]})
+
+
+class MerkleAnchor:
+    """
+    Collects readings off-chain and commits only their Merkle root.
+
+    Readings are grouped per validator; interval seconds after the first one
+    the root is anchored with anchorRoot and on_anchored(documents) stores one
+    document per reading (leaf, proof, transaction) from a worker thread,
+    retried with backoff, so it must be idempotent. Failed anchoring goes back
+    to the next interval; flush_all() anchors what is pending at shutdown.
+    """
+
+    def __init__(self, notarizer, on_anchored, interval=60.0, store_retries=5, retry_delay=1.0):
+        self.interval = interval
+        self.store_retries = store_retries
+        self.retry_delay = retry_delay
+        self._notarizer = notarizer
+        self._on_anchored = on_anchored
+        self._pending = {}
+        self._timers = {}
+        self._tasks = set()
+
+    def add(self, from_address, device_id, kind, value):
+        reading = {
+            "reading_id": uuid.uuid4().hex,
+            "validator_address": from_address,
+            "device_id": device_id,
+            "kind": kind,
+            "value": value,
+            "timestamp": int(time.time())
+        }
+        self._notarizer.loop.call_soon_threadsafe(self._add, reading)
+        return reading
+
+    def flush_all(self, timeout=None):
+        """Anchor every pending reading now and wait for the anchoring to end"""
+        future = asyncio.run_coroutine_threadsafe(self._flush_all(), self._notarizer.loop)
+        try:
+            future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            print("Ancoraggio Merkle non completato entro {} s: {} letture in sospeso".format(
+                timeout, sum(len(readings) for readings in self._pending.values())))
+
+    def _add(self, reading):
+        from_address = reading["validator_address"]
+        pending = self._pending.setdefault(from_address, [])
+        pending.append(reading)
+        if len(pending) == 1:
+            self._timers[from_address] = self._notarizer.loop.call_later(
+                self.interval, self._flush, from_address)
+
+    def _flush(self, from_address):
+        timer = self._timers.pop(from_address, None)
+        if timer is not None:
+            timer.cancel()
+        readings = self._pending.pop(from_address, [])
+        if readings:
+            task = self._notarizer.loop.create_task(self._anchor(from_address, readings))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _flush_all(self):
+        for from_address in list(self._pending):
+            self._flush(from_address)
+        if self._tasks:
+            await asyncio.wait(set(self._tasks))
+
+    async def _anchor(self, from_address, readings):
+        leaves = [merkle.leaf_hash(reading["reading_id"], reading["device_id"], reading["kind"],
+                                   reading["value"], reading["timestamp"]) for reading in readings]
+        levels = merkle.build_tree(leaves)
+        root = merkle.merkle_root(levels)
+        try:
+            tx_hash = await geth.anchor_root(from_address, root, len(readings))
+            result = await self._notarizer.watcher.track(tx_hash)
+        except Exception as e:
+            print("Ancoraggio della radice Merkle fallito: {}".format(e))
+            for reading in readings:
+                self._add(reading)
+            return
+
+        receipt = result["receipt"]
+        documents = [dict(reading,
+                          leaf=leaves[index].hex(),
+                          proof=[node.hex() for node in merkle.merkle_proof(levels, index)],
+                          root=root.hex(),
+                          txID=receipt['transactionHash'].hex(),
+                          block_number=receipt['blockNumber'],
+                          anchored_at=result["timestamp"])
+                     for index, reading in enumerate(readings)]
+        await self._store(root, documents)
+
+    async def _store(self, root, documents):
+        for attempt in range(self.store_retries):
+            try:
+                await self._notarizer.loop.run_in_executor(None, self._on_anchored, documents)
+                return
+            except Exception as e:
+                print("Salvataggio delle foglie della radice Merkle {} fallito (tentativo {}/{}): {}".format(
+                    root.hex(), attempt + 1, self.store_retries, e))
+            if attempt < self.store_retries - 1:
+                await asyncio.sleep(self.retry_delay * 2 ** attempt)
+        # La radice è già su blockchain: le letture restano verificabili
+        # solo reinserendo a mano le foglie
+        print("Foglie della radice Merkle {} non salvate, letture: {}".format(
+            root.hex(), ", ".join(document["reading_id"] for document in documents)))
@@ -1,80 +1,141 @@
+import hashlib
+import io
+import json
 import os
-
-
-# Verifica se una directory esiste sul BeagleBone Black
-def directory_exists(sftp, directory_path):
+import posixpath
+import shlex
+import tarfile
+import uuid
+
+# Local directory and file paths
+LOCAL_MASTER_DIR = 'app/iot-files/Modbus2Chain-master'
+# File distribuiti sul BBB, relativi a LOCAL_MASTER_DIR e alla directory remota
+DEPLOY_PATHS = ['master.py', 'package/umodbus']
+
+# Remote paths on the BeagleBone Black
+REMOTE_MASTER_DIR = '/var/lib/cloud9/Modbus2Chain-master'
+# Manifest remoto: percorso relativo -> sha256 dei file già caricati
+MANIFEST_NAME = '.deploy-manifest.json'
+# I demoni master in esecuzione vengono riavviati dal gateway alla richiesta successiva.
+# [m] impedisce a pkill di riconoscere la riga di comando della shell che lo esegue
+RESTART_COMMAND = "pkill -f '[m]aster.py serve'"
+
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def local_manifest(local_dir=LOCAL_MASTER_DIR, paths=DEPLOY_PATHS):
+    """Hash of every file to deploy, keyed by its path relative to local_dir"""
+    manifest = {}
+    for path in paths:
+        full_path = os.path.join(local_dir, path)
+        if os.path.isfile(full_path):
+            manifest[path] = file_hash(full_path)
+            continue
+        for root, dirs, files in os.walk(full_path):
+            dirs[:] = [d for d in dirs if d != '__pycache__']
+            for filename in files:
+                if filename.endswith('.pyc'):
+                    continue
+                file_path = os.path.join(root, filename)
+                relative_path = os.path.relpath(file_path, local_dir).replace("\\", "/")
+                manifest[relative_path] = file_hash(file_path)
+    return manifest
+
+
+def remote_manifest(sftp, remote_dir=REMOTE_MASTER_DIR):
     try:
-        sftp.stat(directory_path)
-        return True
-    except FileNotFoundError:
-        return False
-
-
-# Verifica se un file esiste sul BeagleBone Black
-def file_exists(sftp, file_path):
+        with sftp.open(posixpath.join(remote_dir, MANIFEST_NAME), 'r') as f:
+            return json.loads(f.read())
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def check_remote(stdout, stderr, action):
+    if stdout.channel.recv_exit_status() != 0:
+        raise RuntimeError("{} failed: {}".format(action, stderr.read().decode('utf-8').strip()))
+
+
+def upload_tar(bbb, local_dir, paths, staging_dir):
+    """Send the given files as one gzip tar stream, extracted in staging_dir"""
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode='w:gz') as tar:
+        for path in paths:
+            tar.add(os.path.join(local_dir, path), arcname=path)
+
+    stdin, stdout, stderr = bbb.exec_command('mkdir -p {0} && tar -xzf - -C {0}'.format(
+        shlex.quote(staging_dir)))
+    stdin.write(buffer.getvalue())
+    stdin.channel.shutdown_write()
+    check_remote(stdout, stderr, "Extracting the upload")
+
+
+def swap_in(bbb, remote_dir, paths, staging_dir):
+    """Move the staged files in place: rename is atomic on the same filesystem"""
+    moves = ' && '.join('mkdir -p {2} && mv -f {0} {1}'.format(
+        shlex.quote(posixpath.join(staging_dir, path)),
+        shlex.quote(posixpath.join(remote_dir, path)),
+        shlex.quote(posixpath.dirname(posixpath.join(remote_dir, path)))) for path in paths)
+    stdin, stdout, stderr = bbb.exec_command('{} && rm -rf {}'.format(moves, shlex.quote(staging_dir)))
+    check_remote(stdout, stderr, "Swapping in the upload")
+
+
+def restart_daemons(bbb):
+    # pkill esce con 1 se nessun demone era in esecuzione
+    stdin, stdout, stderr = bbb.exec_command(RESTART_COMMAND)
+    if stdout.channel.recv_exit_status() > 1:
+        raise RuntimeError("Restarting the master daemons failed: {}".format(
+            stderr.read().decode('utf-8').strip()))
+
+
+def write_manifest(sftp, remote_dir, manifest):
+    manifest_path = posixpath.join(remote_dir, MANIFEST_NAME)
+    with sftp.open(manifest_path + '.tmp', 'w') as f:
+        f.write(json.dumps(manifest, sort_keys=True))
+    sftp.posix_rename(manifest_path + '.tmp', manifest_path)
+
+
+def deploy_files(bbb, local_dir=LOCAL_MASTER_DIR, remote_dir=REMOTE_MASTER_DIR, paths=DEPLOY_PATHS):
+    """
+    Incremental deploy of master.py and umodbus on a gateway.
+
+    Local files are hashed and compared with the manifest of the last deploy,
+    read from the gateway in one SFTP call; only the changed files are sent,
+    as a single tar stream extracted in a staging directory next to the
+    destination, then renamed in place, and the running master daemons are
+    restarted. The manifest is replaced last, so an interrupted deploy is
+    simply redone on the next run. Returns the list of uploaded paths.
+    """
+    manifest = local_manifest(local_dir, paths)
+    sftp = bbb.open_sftp()
     try:
-        sftp.stat(file_path)
-        return True
-    except FileNotFoundError:
-        return False
+        uploaded = remote_manifest(sftp, remote_dir)
+        changed = sorted(path for path, digest in manifest.items() if uploaded.get(path) != digest)
+        if changed:
+            staging_dir = posixpath.join(remote_dir, '.deploy-' + uuid.uuid4().hex)
+            upload_tar(bbb, local_dir, changed, staging_dir)
+            swap_in(bbb, remote_dir, changed, staging_dir)
+        if changed or manifest != uploaded:
+            write_manifest(sftp, remote_dir, manifest)
+        if changed:
+            restart_daemons(bbb)
+    finally:
+        sftp.close()
+    return changed
 
 
 def load_files_on_bbb(bbb):
     try:
-        # Local directory and file paths
-        local_directory_path = 'app/iot-files/Modbus2Chain-master/package/umodbus'
-        local_master_file_path = 'app/iot-files/Modbus2Chain-master/master.py'
-
-        # Remote paths on the BeagleBone Black
-        remote_file_path_micropython_modbus = '/var/lib/cloud9/Modbus2Chain-master/package/umodbus'
-        remote_dir_path_master = '/var/lib/cloud9/Modbus2Chain-master'
-        remote_file_path_master = '/var/lib/cloud9/Modbus2Chain-master/master.py'
-        remote_dir_path_package = '/var/lib/cloud9/Modbus2Chain-master/package'
-        remote_dir_path_umodbus = '/var/lib/cloud9/Modbus2Chain-master/package/umodbus'
-
-        # Initialize the SFTP connection
-        sftp = bbb.open_sftp()
-
-        # Create directories if they don't exist
-        if not directory_exists(sftp, remote_dir_path_master):
-            print("Creating remote directory: {}".format(remote_dir_path_master))
-            sftp.mkdir(remote_dir_path_master)
-
-        if not directory_exists(sftp, remote_dir_path_package):
-            print("Creating remote directory: {}".format(remote_dir_path_package))
-            sftp.mkdir(remote_dir_path_package)
-
-        if not directory_exists(sftp, remote_dir_path_umodbus):
-            print("Creating remote directory: {}".format(remote_dir_path_umodbus))
-            sftp.mkdir(remote_dir_path_umodbus)
-
-        # Get the list of local files
-        remote_files = os.listdir(local_directory_path)
-        local_file_paths = [os.path.normpath(os.path.join(
-            local_directory_path, filename)).replace("\\", "/") for filename in remote_files]
-
-        # Copy files if they don't exist already
-        for local_file_path in local_file_paths:
-            filename = "/" + os.path.basename(local_file_path)
-            remote_file_path = remote_file_path_micropython_modbus + filename
-
-            if not file_exists(sftp, remote_file_path):
-                print("Uploading file {}...".format(filename))
-                sftp.put(local_file_path, remote_file_path)
-            else:
-                print("File {} already exists on the BeagleBone Black.".format(filename))
-
-        # Copy the master.py file if it doesn't exist already
-        if not file_exists(sftp, remote_file_path_master):
-            print("Uploading file master.py...")
-            sftp.put(local_master_file_path, remote_file_path_master)
+        changed = deploy_files(bbb)
+        if changed:
+            print("Uploaded {} file(s): {}".format(len(changed), ", ".join(changed)))
         else:
-            print("File master.py already exists on the BeagleBone Black.")
-
-        # Close the SFTP connection
-        sftp.close()
-
-        print("Upload completed successfully.")
+            print("Files on the BeagleBone Black are up to date.")
         return True
 
     except Exception as e:
@@ -0,0 +1,21 @@
+"""
+Production entry point.
+
+Run from the root of the project, one notarizer and one gateway session per
+worker process (do not use --preload: the notarizer thread does not survive
+the fork):
+
+    gunicorn --pythonpath app -w 4 --threads 8 -b 0.0.0.0:5000 wsgi:app
+    uvicorn --app-dir app --workers 4 --port 5000 wsgi:asgi_app
+"""
+from app import create_app
+
+app = create_app()
+
+# Adattatore ASGI opzionale per uvicorn (richiede asgiref)
+try:
+    from asgiref.wsgi import WsgiToAsgi
+except ImportError:
+    asgi_app = None
+else:
+    asgi_app = WsgiToAsgi(app)
@@ -19,13 +19,22 @@ contract IoTDataNotarization {
 
     mapping(string => Device) public devices;
 
+    //Merkle roots of readings collected off-chain, with their anchoring time
+    mapping(bytes32 => uint) public anchoredRoots;
+
     //Limit thresholds for Event Logs
     uint public temperatureThreshold;
     uint public humidityThreshold;
 
+    //Kinds of readings accepted by recordBatch
+    uint8 public constant KIND_TEMPERATURE = 0;
+    uint8 public constant KIND_HUMIDITY = 1;
+
     //Events
     event TemperatureAlert(string deviceId, uint temperature);
     event HumidityAlert(string deviceId, uint humidity);
+    event RecordRejected(uint index);
+    event RootAnchored(bytes32 root, uint count);
 
     //Functions to set thresholds
     function setTemperatureThreshold(uint _temperatureThreshold) public {
@@ -55,6 +64,28 @@ contract IoTDataNotarization {
         }
     }
 
+    //Function for notarizing many readings in a single transaction.
+    //Readings with an unknown kind are skipped and reported with RecordRejected
+    function recordBatch(string[] calldata deviceIds, uint8[] calldata kinds, uint[] calldata values) external {
+        require(deviceIds.length == kinds.length && kinds.length == values.length, "Array length mismatch");
+
+        for (uint i = 0; i < deviceIds.length; i++) {
+            if (kinds[i] == KIND_TEMPERATURE) {
+                recordTemperature(deviceIds[i], values[i]);
+            } else if (kinds[i] == KIND_HUMIDITY) {
+                recordHumidity(deviceIds[i], values[i]);
+            } else {
+                emit RecordRejected(i);
+            }
+        }
+    }
+
+    //Function for anchoring the Merkle root of the readings of an interval
+    function anchorRoot(bytes32 root, uint count) public {
+        anchoredRoots[root] = block.timestamp;
+        emit RootAnchored(root, count);
+    }
+
     //Functions for reading laetst notarized data
     function readTemperatureRecord(string memory deviceId) public view returns (TemperatureRecord memory) {
         return devices[deviceId].temperatureRecord;